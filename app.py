@@ -1,5 +1,7 @@
 import streamlit as st
 import requests
+import httpx
+import asyncio
 import json
 import pandas as pd
 import plotly.express as px
@@ -10,11 +12,61 @@ from typing import TypedDict, Annotated, List, Dict, Any
 from langgraph.graph import StateGraph, START, END
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_openai import ChatOpenAI
+try:
+    import aiosqlite
+    from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+    from langgraph.checkpoint.sqlite import SqliteSaver
+    from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+except ImportError:
+    # Session checkpointing is disabled without langgraph-checkpoint-sqlite
+    aiosqlite = None
+    JsonPlusSerializer = None
+    SqliteSaver = None
+    AsyncSqliteSaver = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # Parquet export is unavailable without pyarrow
+    pa = None
+    pq = None
+try:
+    import orjson
+except ImportError:
+    # API pages are decoded with the standard library json module
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    # Large API pages are decoded whole instead of incrementally
+    ijson = None
 import re
-from collections import Counter
+import csv
+import tempfile
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+import heapq
+import math
 import io
 import base64
 import os
+import sys
+import threading
+import logging
+import weakref
+import contextvars
+import hashlib
+import hmac
+import secrets
+import unicodedata
+import time
+import uuid
+import sqlite3
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# Background work reports problems through the log instead of the page
+logger = logging.getLogger("trial_navigator")
 
 # Configure Streamlit page
 st.set_page_config(
@@ -120,16 +172,35 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Initialize OpenAI LLM
-@st.cache_resource
-def get_openai_llm(model_name: str = "gpt-3.5-turbo"):
-    """Initialize OpenAI LLM with specified model"""
+@st.cache_resource(show_spinner=False)
+def get_openai_llm(model_name: str = "gpt-3.5-turbo", timeout: float = None):
+    """Initialize OpenAI LLM with specified model and optional request timeout"""
     try:
-        llm = ChatOpenAI(model=model_name, temperature=0.1)
+        llm = ChatOpenAI(model=model_name, temperature=0.1, timeout=timeout)
         return llm
     except Exception as e:
         st.error(f"Error initializing OpenAI with model {model_name}: {str(e)}")
         return None
 
+@st.cache_resource(show_spinner=False)
+def get_async_openai_pool():
+    """Async OpenAI LLMs per event loop: their HTTP clients cannot be reused once run_agent's loop is closed"""
+    return {"lock": threading.Lock(), "loops": weakref.WeakKeyDictionary()}
+
+def get_async_openai_llm(model_name: str = "gpt-3.5-turbo", timeout: float = None):
+    """OpenAI LLM for async calls on the running event loop, dropped together with the loop"""
+    pool = get_async_openai_pool()
+    loop = asyncio.get_running_loop()
+    with pool["lock"]:
+        llms = pool["loops"].setdefault(loop, {})
+        if (model_name, timeout) not in llms:
+            try:
+                llms[(model_name, timeout)] = ChatOpenAI(model=model_name, temperature=0.1, timeout=timeout)
+            except Exception as e:
+                st.error(f"Error initializing OpenAI with model {model_name}: {str(e)}")
+                return None
+        return llms[(model_name, timeout)]
+
 # Function to get available OpenAI models
 @st.cache_data
 def get_available_models():
@@ -148,6 +219,471 @@ def get_available_models():
         st.error(f"Error getting OpenAI models: {str(e)}")
         return ["gpt-3.5-turbo"]  # Fallback to default
 
+# Single-flight layer: identical concurrent calls share one upstream request
+class SingleFlight:
+    """Collapse concurrent calls with the same key into a single in-flight call"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn once per key; concurrent callers with the same key wait for and share its result"""
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+
+        if not is_leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+
+        try:
+            call["result"] = fn(*args, **kwargs)
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            # Forget the key before waking waiters so later calls start a fresh request
+            with self._lock:
+                self._calls.pop(key, None)
+            call["done"].set()
+
+@st.cache_resource(show_spinner=False)
+def get_single_flight():
+    """Process-wide single-flight group shared by all sessions"""
+    return SingleFlight()
+
+class AsyncSingleFlight:
+    """Single-flight for coroutines: concurrent awaits with the same key on one event loop share a call"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        """Await fn once per key and event loop; concurrent callers with the same key share its result"""
+        # Futures belong to one loop, so calls from different loops never share
+        loop_key = (id(asyncio.get_running_loop()), key)
+        call = self._calls.get(loop_key)
+        if call is not None:
+            return await asyncio.shield(call)
+        
+        call = asyncio.ensure_future(fn(*args, **kwargs))
+        self._calls[loop_key] = call
+        try:
+            return await asyncio.shield(call)
+        finally:
+            if call.done():
+                self._calls.pop(loop_key, None)
+            else:
+                call.add_done_callback(lambda _: self._calls.pop(loop_key, None))
+
+@st.cache_resource(show_spinner=False)
+def get_async_single_flight():
+    """Process-wide async single-flight group shared by all sessions"""
+    return AsyncSingleFlight()
+
+def prompt_hash(prompt: str) -> str:
+    """Stable hash of an LLM prompt, used as a coalescing key"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+# Shared result store: heavy payloads are kept once per process, keyed by content hash
+class ResultStore:
+    """Thread-safe LRU store of result payloads keyed by their content hash"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def put(self, payload) -> str:
+        """Store a payload and return its reference (content hash)"""
+        ref = result_hash(payload)
+        with self._lock:
+            if ref in self._entries:
+                self._entries.move_to_end(ref)
+            else:
+                self._entries[ref] = payload
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return ref
+
+    def get(self, ref: str):
+        """Return the payload for a reference, or None if it was evicted"""
+        with self._lock:
+            payload = self._entries.get(ref)
+            if payload is not None:
+                self._entries.move_to_end(ref)
+            return payload
+
+@st.cache_resource(show_spinner=False)
+def get_result_store():
+    """Process-wide result store shared by all sessions"""
+    return ResultStore()
+
+def result_hash(payload) -> str:
+    """Stable content hash of a JSON-like payload"""
+    serialized = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+# State keys whose payloads live in the shared result store between reruns
+HEAVY_STATE_KEYS = ["api_results", "visualization_data", "personalized_recommendations", "risk_assessments"]
+RESULT_REF_KEY = "__result_ref__"
+
+# Maximum number of chat messages kept per session before older ones are compacted
+MAX_CHAT_MESSAGES = 40
+
+def compact_messages(messages: List, max_messages: int = MAX_CHAT_MESSAGES) -> List:
+    """Keep the most recent messages and fold older ones into a single summary message"""
+    if len(messages) <= max_messages:
+        return messages
+    
+    older = messages[:len(messages) - max_messages + 1]
+    recent = messages[len(older):]
+    
+    # Carry forward counts and searches from an earlier summary
+    compacted_count = 0
+    searches = []
+    for message in older:
+        compacted = getattr(message, "additional_kwargs", {}).get("compacted")
+        if compacted:
+            compacted_count += compacted["count"]
+            searches.extend(compacted["searches"])
+        else:
+            compacted_count += 1
+            if isinstance(message, HumanMessage):
+                searches.append(message.content)
+    
+    searches = searches[-10:]
+    summary = f"Earlier conversation summary: {compacted_count} older messages were compacted."
+    if searches:
+        summary += f" Previous searches: {', '.join(searches)}."
+    summary_message = AIMessage(
+        content=summary,
+        additional_kwargs={"compacted": {"count": compacted_count, "searches": searches}}
+    )
+    return [summary_message] + recent
+
+def dehydrate_state(state: Dict[str, Any], pinned: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Replace heavy payloads with result-store references and bound the message log
+
+    pinned, when given, is replaced by the session's own references to its payloads, so evictions from the
+    shared store never lose a live session's results; it holds the stored objects, so nothing is copied.
+    """
+    store = get_result_store()
+    compact_state = dict(state)
+    session_payloads = {}
+    for key in HEAVY_STATE_KEYS:
+        payload = compact_state.get(key)
+        if isinstance(payload, dict) and RESULT_REF_KEY in payload:
+            ref = payload[RESULT_REF_KEY]
+            payload = store.get(ref) or (pinned or {}).get(ref)
+        elif payload:
+            ref = store.put(payload)
+            # Identical results share the object already in the store
+            payload = store.get(ref) or payload
+            compact_state[key] = {RESULT_REF_KEY: ref}
+        if payload:
+            session_payloads[ref] = payload
+    if pinned is not None:
+        pinned.clear()
+        pinned.update(session_payloads)
+    compact_state["messages"] = compact_messages(compact_state.get("messages", []))
+    return compact_state
+
+def hydrate_state(state: Dict[str, Any], pinned: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Resolve result-store references back into payloads, falling back to the session's pinned payloads"""
+    store = get_result_store()
+    full_state = dict(state)
+    for key in HEAVY_STATE_KEYS:
+        payload = full_state.get(key)
+        if isinstance(payload, dict) and RESULT_REF_KEY in payload:
+            ref = payload[RESULT_REF_KEY]
+            resolved = store.get(ref)
+            if resolved is None and pinned and ref in pinned:
+                # Evicted by other sessions' searches: share the session's copy again
+                resolved = pinned[ref]
+                store.put(resolved)
+            # A result neither stored nor pinned behaves like an empty one; the next search repopulates it
+            if resolved is None:
+                resolved = [] if key == "personalized_recommendations" else {}
+            full_state[key] = resolved
+    return full_state
+
+# Response cache: processed upstream results, shared across sessions until they expire
+class ResponseCache:
+    """Thread-safe LRU cache whose entries expire after a time-to-live"""
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 900):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Return the cached value, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store a value, evicting the least recently used entries beyond max_entries"""
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Process-wide cache of trial search responses"""
+    return ResponseCache(ttl_seconds=float(os.getenv("TRIALS_CACHE_TTL_SECONDS", "900")))
+
+@st.cache_resource(show_spinner=False)
+def get_llm_cache():
+    """Process-wide cache of LLM completions keyed by model and prompt hash"""
+    return ResponseCache(max_entries=2048, ttl_seconds=float(os.getenv("LLM_CACHE_TTL_SECONDS", "86400")))
+
+# Saved searches not run for this long are deleted (default 30 days)
+SAVED_SEARCH_TTL_SECONDS = float(os.getenv("SAVED_SEARCH_TTL_SECONDS", "2592000"))
+# Minimum seconds between two saved-search prune passes
+SAVED_SEARCH_PRUNE_INTERVAL_SECONDS = 3600
+
+# Saved searches: last result set per search, patched incrementally on revisit
+class SavedSearchStore:
+    """SQLite-backed store of saved search results, the date they were last refreshed and when they were last used"""
+
+    def __init__(self, path: str, ttl_seconds: float = SAVED_SEARCH_TTL_SECONDS):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self._last_prune = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS saved_searches ("
+                "search_key TEXT PRIMARY KEY, refreshed_on TEXT NOT NULL, results TEXT NOT NULL, used_at REAL NOT NULL DEFAULT 0)"
+            )
+            try:
+                # Searches saved before last use was tracked start their TTL now
+                self._conn.execute("ALTER TABLE saved_searches ADD COLUMN used_at REAL NOT NULL DEFAULT 0")
+                self._conn.execute("UPDATE saved_searches SET used_at = ?", (time.time(),))
+            except sqlite3.OperationalError:
+                pass
+
+    def load(self, search_key: str):
+        """Return (refreshed_on, results) for a saved search, or None"""
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT refreshed_on, results FROM saved_searches WHERE search_key = ?", (search_key,)
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE saved_searches SET used_at = ? WHERE search_key = ?", (time.time(), search_key))
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def save(self, search_key: str, refreshed_on: str, results: Dict[str, Any]):
+        """Store the result set for a search, pruning searches unused for ttl_seconds at most once per interval"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO saved_searches (search_key, refreshed_on, results, used_at) VALUES (?, ?, ?, ?)",
+                (search_key, refreshed_on, json.dumps(results), now)
+            )
+            if now - self._last_prune >= SAVED_SEARCH_PRUNE_INTERVAL_SECONDS:
+                self._last_prune = now
+                self._conn.execute("DELETE FROM saved_searches WHERE used_at < ?", (now - self.ttl_seconds,))
+
+@st.cache_resource(show_spinner=False)
+def get_saved_search_store():
+    """Process-wide saved search store"""
+    return SavedSearchStore(os.getenv("SAVED_SEARCHES_PATH", ".trial_navigator/saved_searches.db"))
+
+# Query log: how often each (condition, filters) search is run, used to pick what to warm
+class QueryLog:
+    """Thread-safe counter of searches"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def record(self, condition: str, filters: Dict[str, str]):
+        """Count one search for a condition with its server-side filters"""
+        with self._lock:
+            self._counts[search_key(condition, filters)] += 1
+
+    def top(self, n: int) -> List:
+        """The n most frequent searches as (condition, filters) pairs"""
+        with self._lock:
+            most_common = self._counts.most_common(n)
+        return [tuple(json.loads(search)) for search, _ in most_common]
+
+@st.cache_resource(show_spinner=False)
+def get_query_log():
+    """Process-wide query log"""
+    return QueryLog()
+
+# Rate limiting: process-wide token buckets per upstream, shared fairly between sessions
+current_session_id = contextvars.ContextVar("current_session_id", default="anonymous")
+
+class RateLimiter:
+    """Token bucket per upstream; queued requests are granted round-robin across sessions"""
+
+    def __init__(self, limits: Dict[str, tuple], window: int = 200):
+        # limits: upstream prefix -> (requests per second, burst); upstreams without a limit pass straight through
+        self.limits = limits
+        self.window = window
+        self._condition = threading.Condition()
+        self._upstreams = {}
+
+    def _limit(self, upstream: str):
+        for prefix, limit in self.limits.items():
+            if upstream == prefix or upstream.startswith(prefix + ":"):
+                return limit
+        return None
+
+    def _dispatch(self, upstream: Dict[str, Any]):
+        """Refill the bucket and grant tokens to queued tickets, one session at a time"""
+        now = time.monotonic()
+        upstream["tokens"] = min(upstream["burst"], upstream["tokens"] + (now - upstream["updated"]) * upstream["rate"])
+        upstream["updated"] = now
+        queue = upstream["queue"]
+        granted = False
+        while queue and upstream["tokens"] >= 1:
+            session_id, tickets = next(iter(queue.items()))
+            tickets.popleft()["granted"] = True
+            upstream["tokens"] -= 1
+            granted = True
+            # The session goes to the back of the rotation, or leaves it when it has nothing queued
+            del queue[session_id]
+            if tickets:
+                queue[session_id] = tickets
+        if granted:
+            self._condition.notify_all()
+
+    def _enqueue(self, name: str):
+        """Queue a ticket for the current session; None when the upstream is not limited"""
+        limit = self._limit(name)
+        if limit is None:
+            return None, None
+        upstream = self._upstreams.get(name)
+        if upstream is None:
+            rate, burst = limit
+            upstream = {
+                "rate": rate, "burst": burst, "tokens": burst, "updated": time.monotonic(),
+                "queue": OrderedDict(), "granted": 0, "timeouts": 0, "waits": []
+            }
+            self._upstreams[name] = upstream
+        ticket = {"granted": False, "queued_at": time.monotonic()}
+        upstream["queue"].setdefault(current_session_id.get(), deque()).append(ticket)
+        self._dispatch(upstream)
+        return upstream, ticket
+
+    def _finish(self, upstream: Dict[str, Any], ticket: Dict[str, Any]) -> float:
+        waited = time.monotonic() - ticket["queued_at"]
+        if ticket["granted"]:
+            upstream["granted"] += 1
+            upstream["waits"].append(waited)
+            del upstream["waits"][:-self.window]
+        else:
+            upstream["timeouts"] += 1
+            session_tickets = upstream["queue"].get(current_session_id.get())
+            if session_tickets is not None and ticket in session_tickets:
+                session_tickets.remove(ticket)
+                if not session_tickets:
+                    del upstream["queue"][current_session_id.get()]
+        return waited
+
+    def _next_token_seconds(self, upstream: Dict[str, Any]) -> float:
+        return max((1 - upstream["tokens"]) / upstream["rate"], 0.001)
+
+    def acquire(self, name: str, timeout: float = None) -> float:
+        """Block until the upstream grants a request; returns the wait in seconds, raises TimeoutError on timeout"""
+        with self._condition:
+            upstream, ticket = self._enqueue(name)
+            if upstream is None:
+                return 0.0
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not ticket["granted"]:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._finish(upstream, ticket)
+                    raise TimeoutError(f"Rate limit wait for {name} exceeded {timeout}s")
+                wait = self._next_token_seconds(upstream)
+                self._condition.wait(wait if remaining is None else min(wait, remaining))
+                self._dispatch(upstream)
+            return self._finish(upstream, ticket)
+
+    async def aacquire(self, name: str, timeout: float = None) -> float:
+        """Async variant of acquire that sleeps on the event loop instead of blocking a thread"""
+        with self._condition:
+            upstream, ticket = self._enqueue(name)
+            if upstream is None:
+                return 0.0
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                self._dispatch(upstream)
+                if ticket["granted"]:
+                    return self._finish(upstream, ticket)
+                if deadline is not None and time.monotonic() >= deadline:
+                    self._finish(upstream, ticket)
+                    raise TimeoutError(f"Rate limit wait for {name} exceeded {timeout}s")
+                wait = self._next_token_seconds(upstream)
+            await asyncio.sleep(wait)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Grants, timeouts, queue depth and wait times per upstream for the metrics panel"""
+        snapshot = {}
+        with self._condition:
+            for name, upstream in self._upstreams.items():
+                waits = sorted(upstream["waits"])
+                snapshot[name] = {
+                    "granted": upstream["granted"],
+                    "timeouts": upstream["timeouts"],
+                    "queued": sum(len(tickets) for tickets in upstream["queue"].values()),
+                    "waiting_sessions": len(upstream["queue"]),
+                    "p50_wait_seconds": round(percentile(waits, 0.5), 3) if waits else 0.0,
+                    "p95_wait_seconds": round(percentile(waits, 0.95), 3) if waits else 0.0
+                }
+        return snapshot
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter():
+    """Process-wide rate limiter for ClinicalTrials.gov and each OpenAI model"""
+    return RateLimiter({
+        "trials": (float(os.getenv("TRIALS_RATE_LIMIT_PER_MINUTE", "50")) / 60, float(os.getenv("TRIALS_RATE_LIMIT_BURST", "10"))),
+        "openai": (float(os.getenv("OPENAI_RATE_LIMIT_PER_MINUTE", "500")) / 60, float(os.getenv("OPENAI_RATE_LIMIT_BURST", "20")))
+    })
+
+# Longest a trials API request waits for a rate limit token
+TRIALS_RATE_LIMIT_WAIT_SECONDS = 30
+
+# Maximum number of conditions searched concurrently for one query
+MAX_SEARCH_CONDITIONS = 5
+
+def state_ref(state: Dict[str, Any], key: str):
+    """Return the result-store reference held for a state key, if any"""
+    payload = state.get(key)
+    if isinstance(payload, dict):
+        return payload.get(RESULT_REF_KEY)
+    return None
+
 # Helper function to parse age values from various formats
 def parse_age(age_value) -> int:
     """Parse age values from various formats like '18 Years', '65+', etc."""
@@ -167,6 +703,238 @@ def parse_age(age_value) -> int:
     except (ValueError, TypeError):
         return 0
 
+# Eligibility criteria parser: precompiled patterns and a rule table, no LLM needed
+CRITERIA_SECTION_PATTERN = re.compile(r"^\s*(?:key\s+)?(inclusion|exclusion)\s+criteria\s*:?\s*$", re.IGNORECASE | re.MULTILINE)
+CRITERIA_BULLET_PATTERN = re.compile(r"^\s*(?:[*\-•●▪◦]|\d{1,2}[.)])\s+")
+CRITERIA_CLAUSE_PATTERN = re.compile(r"[;,()\[\]]|\.\s")
+# Words allowed between a rule keyword and its value, e.g. "Age: between", "ECOG performance status of"
+CRITERIA_LEAD_PATTERN = re.compile(
+    r"[\s:=]*(?:(?:is|of|be|must|should|between|from|aged?|ages|in|the|range|performance|status|ps|score|level|value)\b[\s:=]*)*",
+    re.IGNORECASE
+)
+CRITERIA_NUMBER = r"(\d+(?:\.\d+)?)"
+CRITERIA_RANGE_PATTERN = re.compile(rf"(?:between\s+)?{CRITERIA_NUMBER}\s*%?\s*(?:-|–|to|and)\s*{CRITERIA_NUMBER}", re.IGNORECASE)
+CRITERIA_COMPARATOR = (
+    r"(≥|>=|=>|≤|<=|=<|>|<|at least|greater than or equal to|less than or equal to|greater than|more than|"
+    r"less than|no more than|not more than|over|above|under|below|up to)"
+)
+CRITERIA_COMPARISON_PATTERN = re.compile(rf"{CRITERIA_COMPARATOR}\s*(?:of\s+)?{CRITERIA_NUMBER}", re.IGNORECASE)
+# Second side of a two-sided comparison, e.g. "≥ 7.0% and ≤ 10.5%"
+CRITERIA_SECOND_COMPARISON_PATTERN = re.compile(
+    rf"\s*(?:%|years?|yrs?)?\s*(?:(and|or|but)\s*)?{CRITERIA_COMPARATOR}\s*(?:of\s+)?{CRITERIA_NUMBER}",
+    re.IGNORECASE
+)
+CRITERIA_POSTFIX_PATTERN = re.compile(
+    rf"{CRITERIA_NUMBER}\s*(?:%|years?|yrs?)?\s*(?:of age\s*)?(or older|and older|or over|and over|or above|and above|"
+    rf"or more|or greater|\+|or younger|and younger|or less|or under|or below)",
+    re.IGNORECASE
+)
+CRITERIA_INTEGER_PATTERN = re.compile(r"\b\d\b")
+PREGNANCY_PATTERN = re.compile(r"\b(?:pregnan\w*|breast[- ]?feeding|lactating|nursing)\b", re.IGNORECASE)
+
+# Comparators that set a lower bound when they appear in inclusion criteria
+LOWER_BOUND_OPERATORS = {
+    "≥", ">=", "=>", ">", "at least", "greater than or equal to", "greater than", "more than", "over", "above",
+    "or older", "and older", "or over", "and over", "or above", "and above", "or more", "or greater", "+"
+}
+# Comparators that exclude the boundary value itself
+STRICT_OPERATORS = {">", "<", "greater than", "more than", "less than", "over", "above", "under", "below"}
+
+# Numeric constraints extracted from criteria: keyword that marks the clause, value sanity limit, integer scale
+CRITERIA_RULES = [
+    # Age values need a years unit unless the keyword itself is "age"/"aged" or the unit ("18 years old")
+    {"name": "age", "keyword": re.compile(r"\bage[ds]?\b|\badults?\b|\byears? old\b", re.IGNORECASE), "max_value": 120, "integer": True,
+     "unit": re.compile(r"\s*(?:years?|yrs?|y/o)\b|\s*-\s*years?\b", re.IGNORECASE)},
+    {"name": "hba1c", "keyword": re.compile(r"\b(?:hba1c|hb a1c|a1c|glycated ha?emoglobin)\b", re.IGNORECASE), "max_value": 20, "integer": False},
+    {"name": "ecog", "keyword": re.compile(r"\becog\b", re.IGNORECASE), "max_value": 5, "integer": True, "value_list": True},
+]
+
+def split_criteria(text: str) -> Dict[str, List[str]]:
+    """Split eligibility criteria text into inclusion and exclusion bullet lists"""
+    sections = {"inclusion": [], "exclusion": []}
+    if not text:
+        return sections
+    
+    # Text before any section header counts as inclusion criteria
+    headers = list(CRITERIA_SECTION_PATTERN.finditer(text))
+    blocks = [("inclusion", text[:headers[0].start()] if headers else text)]
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+        blocks.append((header.group(1).lower(), text[header.end():end]))
+    
+    for section, block in blocks:
+        bullets = sections[section]
+        for line in block.splitlines():
+            if not line.strip():
+                continue
+            bullet_start = CRITERIA_BULLET_PATTERN.match(line)
+            if bullet_start or not bullets:
+                bullets.append(line[bullet_start.end():].strip() if bullet_start else line.strip())
+            else:
+                # Wrapped continuation of the previous bullet
+                bullets[-1] += " " + line.strip()
+    
+    return sections
+
+def extract_bounds(bullet: str, rule: Dict[str, Any], exclusion: bool) -> Dict[str, float]:
+    """Extract min/max bounds for one rule from a single criteria bullet"""
+    # A keyword without a value of its own, like "Adults" in "Adults (≥18 years old)", gives way to the next one
+    for keyword in rule["keyword"].finditer(bullet):
+        bounds = keyword_bounds(bullet, keyword, rule, exclusion)
+        if bounds:
+            return bounds
+    return {}
+
+def keyword_bounds(bullet: str, keyword: re.Match, rule: Dict[str, Any], exclusion: bool) -> Dict[str, float]:
+    """Min/max bounds given by the value next to one keyword occurrence"""
+    # Only look at the keyword's clause: it ends at punctuation or where another rule's keyword starts,
+    # so numbers of other measures in the same bullet (e.g. "Age >= 18 years, HbA1c 7-10%") are not picked up
+    separator = CRITERIA_CLAUSE_PATTERN.search(bullet, keyword.end())
+    clause_end = separator.start() if separator else len(bullet)
+    clause_start = 0
+    for separator in CRITERIA_CLAUSE_PATTERN.finditer(bullet, 0, keyword.start()):
+        clause_start = separator.end()
+    for other in CRITERIA_RULES:
+        if other is rule:
+            continue
+        for other_keyword in other["keyword"].finditer(bullet, clause_start, clause_end):
+            if other_keyword.start() >= keyword.end():
+                clause_end = min(clause_end, other_keyword.start())
+            elif other_keyword.end() <= keyword.start():
+                clause_start = max(clause_start, other_keyword.end())
+    after_keyword = bullet[:clause_end]
+    # The value must directly follow the keyword, allowing only filler words such as "of" or "between"
+    value_start = CRITERIA_LEAD_PATTERN.match(after_keyword, keyword.end()).end()
+    
+    def valid(value):
+        return 0 <= value <= rule["max_value"]
+    
+    def has_unit(match):
+        unit = rule.get("unit")
+        if unit is None or keyword.group(0).lower().startswith(("age", "year")):
+            return True
+        return bool(unit.match(bullet, match.end(match.lastindex)) or unit.search(match.group(0)))
+    
+    def before_keyword(pattern):
+        # Values written just before a trailing keyword, e.g. "18 to 65 years old"
+        candidates = [
+            candidate for candidate in pattern.finditer(bullet, clause_start, keyword.start())
+            if not bullet[candidate.end():keyword.start()].strip()
+        ]
+        return candidates[-1] if candidates else None
+    
+    def comparison_bounds(operator, value):
+        is_lower = operator in LOWER_BOUND_OPERATORS
+        is_strict = operator in STRICT_OPERATORS
+        step = 1 if rule["integer"] else 0
+        if exclusion:
+            # Excluding "x >= v" means x must stay below v, and vice versa
+            if is_lower:
+                return {"max": value if is_strict else value - step}
+            return {"min": value if is_strict else value + step}
+        if is_lower:
+            return {"min": value + step if is_strict else value}
+        return {"max": value - step if is_strict else value}
+    
+    match = CRITERIA_RANGE_PATTERN.match(after_keyword, value_start) or before_keyword(CRITERIA_RANGE_PATTERN)
+    if match and valid(float(match.group(1))) and valid(float(match.group(2))) and has_unit(match):
+        # Excluding a middle range cannot be expressed as a single bound
+        return {} if exclusion else {"min": float(match.group(1)), "max": float(match.group(2))}
+    
+    operator = value = second = None
+    match = CRITERIA_COMPARISON_PATTERN.match(after_keyword, value_start)
+    if match and has_unit(match):
+        operator, value = match.group(1).lower(), float(match.group(2))
+        second = CRITERIA_SECOND_COMPARISON_PATTERN.match(after_keyword, match.end())
+    else:
+        # "18 years or older" after the keyword, or "18 years of age or older" around it
+        match = CRITERIA_POSTFIX_PATTERN.match(after_keyword, value_start)
+        if not match:
+            match = next(
+                (candidate for candidate in CRITERIA_POSTFIX_PATTERN.finditer(bullet, clause_start, clause_end)
+                 if candidate.start() <= keyword.start() < candidate.end()),
+                None
+            )
+        if match and has_unit(match):
+            operator, value = match.group(2).lower(), float(match.group(1))
+        else:
+            # "≥18 years old"
+            match = before_keyword(CRITERIA_COMPARISON_PATTERN)
+            if match and has_unit(match):
+                operator, value = match.group(1).lower(), float(match.group(2))
+    
+    if operator is None:
+        if rule.get("value_list"):
+            values = [float(v) for v in CRITERIA_INTEGER_PATTERN.findall(after_keyword, value_start)]
+            values = [v for v in values if valid(v)]
+            if values and not exclusion:
+                return {"min": min(values), "max": max(values)}
+        return {}
+    if not valid(value):
+        return {}
+    
+    bounds = comparison_bounds(operator, value)
+    if second and valid(float(second.group(3))):
+        other = comparison_bounds(second.group(2).lower(), float(second.group(3)))
+        if set(other) != set(bounds):
+            # Both sides hold when included with "and", or excluded with "or" ("< 7 or > 10");
+            # an excluded middle range or either of two open ranges cannot be expressed as bounds
+            if ((second.group(1) or "and").lower() == "or") != exclusion:
+                return {}
+            bounds.update(other)
+    return bounds
+
+def parse_eligibility_criteria(text: str) -> Dict[str, Any]:
+    """Parse eligibility criteria into bullet lists and structured numeric constraints"""
+    sections = split_criteria(text)
+    constraints = {}
+    
+    for section in ("inclusion", "exclusion"):
+        for bullet in sections[section]:
+            for rule in CRITERIA_RULES:
+                bounds = extract_bounds(bullet, rule, exclusion=section == "exclusion")
+                if not bounds:
+                    continue
+                # Tighten bounds across bullets
+                current = constraints.setdefault(rule["name"], {})
+                if "min" in bounds:
+                    current["min"] = max(current.get("min", bounds["min"]), bounds["min"])
+                if "max" in bounds:
+                    current["max"] = min(current.get("max", bounds["max"]), bounds["max"])
+    
+    return {
+        "inclusion": sections["inclusion"],
+        "exclusion": sections["exclusion"],
+        "constraints": constraints,
+        "excludes_pregnancy": any(PREGNANCY_PATTERN.search(bullet) for bullet in sections["exclusion"])
+    }
+
+def criteria_conflicts(parsed_criteria: Dict[str, Any], user_profile: Dict[str, Any]) -> List[str]:
+    """List structured criteria the user profile fails; profile values that are not set are not checked"""
+    conflicts = []
+    constraints = parsed_criteria.get("constraints", {})
+    
+    profile_values = {
+        "age": user_profile.get("age"),
+        "hba1c": user_profile.get("hba1c"),
+        "ecog": user_profile.get("ecog")
+    }
+    for name, value in profile_values.items():
+        bounds = constraints.get(name)
+        if value is None or not bounds:
+            continue
+        if value < bounds.get("min", value) or value > bounds.get("max", value):
+            conflicts.append(f"{name} {value} outside criteria range ({bounds.get('min', '-')}-{bounds.get('max', '-')})")
+    
+    if user_profile.get("pregnant") and parsed_criteria.get("excludes_pregnancy"):
+        conflicts.append("Trial excludes pregnant or breastfeeding participants")
+    
+    return conflicts
+
+def profile_needs_criteria(user_profile: Dict[str, Any]) -> bool:
+    """Whether the profile sets values only criteria text can rule on; age is already filtered on the structured ages"""
+    return user_profile.get("hba1c") is not None or user_profile.get("ecog") is not None or bool(user_profile.get("pregnant"))
+
 # Simple geocoding function for major cities
 def get_city_coordinates(city: str, country: str) -> Dict[str, float]:
     """Get coordinates for major cities"""
@@ -303,12 +1071,20 @@ class AgentState(TypedDict):
     needs_clarification: bool
     clarification_question: str
     selected_model: str
+    user_profile: Dict[str, Any]
+    profile_aggregates: Dict[str, Any]
+    personalized_recommendations: List[Dict[str, Any]]
+    risk_assessments: Dict[str, Any]
+    quality_metrics: Dict[str, Any]
+    search_strategy: Dict[str, Any]
+    needs_research: bool
+    profile_refinement: Dict[str, Any]
+    deadline: float
+    degraded: List[str]
 
-# Initialize session state
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-if "agent_state" not in st.session_state:
-    st.session_state.agent_state = {
+def new_agent_state() -> Dict[str, Any]:
+    """Fresh agent state for a new session or headless run"""
+    return {
         "messages": [],
         "disease_name": "",
         "api_results": {},
@@ -319,28 +1095,108 @@ if "agent_state" not in st.session_state:
         "selected_model": "gpt-3.5-turbo",
         # Initialize new fields
         "user_profile": {},
+        "profile_aggregates": {},
         "risk_assessments": {},
-        "personalized_recommendations": []
+        "personalized_recommendations": [],
+        "deadline": 0,
+        "degraded": []
     }
 
-# Real LLM function using OpenAI
-def real_llm(prompt: str, model_name: str = "gpt-3.5-turbo") -> str:
-    """Real LLM function using OpenAI for cloud inference"""
-    try:
-        llm = get_openai_llm(model_name)
-        if llm is None:
-            return "Error: Could not initialize OpenAI LLM. Please check your API key and model availability."
-        
-        # Create a more specific prompt for better results
-        if "clarify" in prompt.lower():
-            enhanced_prompt = f"""You are a helpful medical assistant. The user has entered a disease term that might be too general. 
+# Initialize session state
+if "messages" not in st.session_state:
+    st.session_state.messages = []
+if "agent_state" not in st.session_state:
+    st.session_state.agent_state = new_agent_state()
+# The session's own references to the heavy payloads behind agent_state
+if "result_payloads" not in st.session_state:
+    st.session_state.result_payloads = {}
+
+# Cheapest model, used for tasks a small model handles fine
+CHEAP_LLM_MODEL = os.getenv("CHEAP_LLM_MODEL", "gpt-3.5-turbo")
+
+# Task-aware routing: candidates are tried in order, each within the task's latency budget.
+# "selected" is the user's model, "cheap" is CHEAP_LLM_MODEL and "template" answers locally.
+LLM_TASK_ROUTES = {
+    "clarify": {"budget_seconds": 5, "candidates": ["cheap", "template"]},
+    "simplify": {"budget_seconds": 30, "candidates": ["selected", "cheap", "template"]},
+    "general": {"budget_seconds": 10, "candidates": ["cheap", "template"]}
+}
+
+# Minimum samples before a route's latency history is trusted for routing decisions
+MIN_LATENCY_SAMPLES = 5
+# Seconds after which a route skipped for being slow is probed again
+LATENCY_PROBE_SECONDS = 60
+
+def percentile(sorted_samples: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of pre-sorted samples"""
+    return sorted_samples[int(fraction * (len(sorted_samples) - 1))]
+
+class LatencyStats:
+    """Per-task, per-route latency and failure statistics over a sliding window"""
+
+    def __init__(self, window: int = 100):
+        self.window = window
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, task: str, route: str, seconds: float, ok: bool):
+        """Record one call's latency and outcome"""
+        with self._lock:
+            stats = self._routes.setdefault((task, route), {"samples": [], "calls": 0, "failures": 0, "last_call": 0})
+            stats["samples"].append(seconds)
+            del stats["samples"][:-self.window]
+            stats["calls"] += 1
+            stats["failures"] += 0 if ok else 1
+            stats["last_call"] = time.time()
+
+    def is_slow(self, task: str, route: str, budget_seconds: float) -> bool:
+        """Whether the route's p95 exceeds the budget; slow routes are probed again after a while"""
+        with self._lock:
+            stats = self._routes.get((task, route))
+            if not stats or len(stats["samples"]) < MIN_LATENCY_SAMPLES:
+                return False
+            if time.time() - stats["last_call"] > LATENCY_PROBE_SECONDS:
+                return False
+            return percentile(sorted(stats["samples"]), 0.95) > budget_seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Current statistics for the metrics panel"""
+        snapshot = {}
+        with self._lock:
+            for (task, route), stats in self._routes.items():
+                samples = sorted(stats["samples"])
+                snapshot[f"{task}/{route}"] = {
+                    "calls": stats["calls"],
+                    "failures": stats["failures"],
+                    "p50_seconds": round(percentile(samples, 0.5), 3),
+                    "p95_seconds": round(percentile(samples, 0.95), 3)
+                }
+        return snapshot
+
+@st.cache_resource(show_spinner=False)
+def get_llm_latency_stats():
+    """Process-wide LLM latency statistics"""
+    return LatencyStats()
+
+def detect_llm_task(prompt: str) -> str:
+    """Infer the task from the prompt prefix"""
+    if "clarify" in prompt.lower():
+        return "clarify"
+    if "simplify" in prompt.lower():
+        return "simplify"
+    return "general"
+
+def build_llm_prompt(task: str, prompt: str) -> str:
+    """Create a more specific prompt for better results"""
+    if task == "clarify":
+        return f"""You are a helpful medical assistant. The user has entered a disease term that might be too general. 
             Please ask for clarification in a friendly, professional way. 
             
             User input: {prompt}
             
             Respond with a clear question asking for more specific information about the disease or condition."""
-        elif "simplify" in prompt.lower():
-            enhanced_prompt = f"""You are a medical translator who simplifies complex clinical trial eligibility criteria into plain, 
+    if task == "simplify":
+        return f"""You are a medical translator who simplifies complex clinical trial eligibility criteria into plain, 
             easy-to-understand language for patients and caregivers. 
             
             Original criteria: {prompt}
@@ -351,101 +1207,1136 @@ def real_llm(prompt: str, model_name: str = "gpt-3.5-turbo") -> str:
             3. Any important considerations
             
             Use simple language that a non-medical person can understand."""
-        else:
-            enhanced_prompt = f"""You are a helpful medical assistant helping patients find clinical trials. 
+    return f"""You are a helpful medical assistant helping patients find clinical trials. 
             Please provide a helpful response to: {prompt}"""
-        
-        response = llm.invoke(enhanced_prompt)
+
+# Example follow-ups for ambiguous terms, used by the local clarification template
+CLARIFY_EXAMPLES = {
+    "cancer": "'breast cancer', 'lung cancer', 'melanoma'",
+    "tumor": "'brain tumor', 'carcinoid tumor', 'Wilms tumor'",
+    "disease": "'heart disease', 'kidney disease', 'Crohn's disease'"
+}
+
+def template_llm_response(task: str, prompt: str) -> str:
+    """Local template answers, used as the cheapest route and as the last-resort fallback"""
+    if task == "clarify":
+        for term, examples in CLARIFY_EXAMPLES.items():
+            if term in prompt.lower():
+                return f"Could you please specify the type of {term}? For example: {examples}, etc."
+        return "Could you please be more specific about the condition? For example, its type or the part of the body it affects."
+    if task == "simplify":
+        return "Based on the trial criteria, you may be eligible if you: are 18 years or older, have been diagnosed with the condition, and are in generally good health. You may not be eligible if you: are pregnant, have certain other medical conditions, or are taking specific medications."
+    return "I understand you're looking for clinical trials. Let me help you find relevant information."
+
+def plan_llm_routes(task: str, model_name: str) -> List:
+    """Ordered (route, model) candidates for a task, skipping models whose p95 blows the task budget"""
+    route_config = LLM_TASK_ROUTES.get(task, LLM_TASK_ROUTES["general"])
+    stats = get_llm_latency_stats()
+    models = {"selected": model_name, "cheap": CHEAP_LLM_MODEL, "template": None}
+    
+    routes = []
+    tried_models = set()
+    for candidate in route_config["candidates"]:
+        model = models[candidate]
+        if candidate != "template":
+            if model in tried_models or stats.is_slow(task, model, route_config["budget_seconds"]):
+                continue
+            tried_models.add(model)
+        routes.append((candidate, model))
+    return routes
+
+# Pluggable LLM backends behind real_llm
+class LLMBackend(ABC):
+    """Interface for completion backends: answer a task prompt with a model within a timeout"""
+    name = "base"
+
+    @abstractmethod
+    def complete(self, task: str, prompt: str, model_name: str, timeout: float) -> str:
+        """Blocking completion"""
+
+    async def acomplete(self, task: str, prompt: str, model_name: str, timeout: float) -> str:
+        """Async completion; by default complete runs in a worker thread, backends with native async support override it"""
+        return await asyncio.to_thread(self.complete, task, prompt, model_name, timeout)
+
+class OpenAIBackend(LLMBackend):
+    """OpenAI chat models for cloud inference"""
+    name = "openai"
+
+    def complete(self, task: str, prompt: str, model_name: str, timeout: float) -> str:
+        # Deadline-capped timeouts are rounded up to whole seconds so cached clients stay few
+        llm = get_openai_llm(model_name, math.ceil(timeout))
+        if llm is None:
+            raise RuntimeError("Could not initialize OpenAI LLM. Please check your API key and model availability.")
+        response = llm.invoke(build_llm_prompt(task, prompt))
         return response.content if hasattr(response, 'content') else str(response)
-        
+
+    async def acomplete(self, task: str, prompt: str, model_name: str, timeout: float) -> str:
+        llm = get_async_openai_llm(model_name, math.ceil(timeout))
+        if llm is None:
+            raise RuntimeError("Could not initialize OpenAI LLM. Please check your API key and model availability.")
+        response = await llm.ainvoke(build_llm_prompt(task, prompt))
+        return response.content if hasattr(response, 'content') else str(response)
+
+class LocalRuleBackend(LLMBackend):
+    """Deterministic rule-based backend with simulated latency, for offline use and load tests"""
+    name = "local"
+
+    def __init__(self, latency_seconds: float = 0.0):
+        self.latency_seconds = latency_seconds
+
+    def complete(self, task: str, prompt: str, model_name: str, timeout: float) -> str:
+        if timeout is not None and self.latency_seconds > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"Local backend latency {self.latency_seconds}s exceeds {timeout}s timeout")
+        time.sleep(self.latency_seconds)
+        if task == "simplify":
+            return local_simplify_criteria(prompt)
+        return template_llm_response(task, prompt)
+
+    async def acomplete(self, task: str, prompt: str, model_name: str, timeout: float) -> str:
+        if timeout is not None and self.latency_seconds > timeout:
+            await asyncio.sleep(timeout)
+            raise TimeoutError(f"Local backend latency {self.latency_seconds}s exceeds {timeout}s timeout")
+        await asyncio.sleep(self.latency_seconds)
+        if task == "simplify":
+            return local_simplify_criteria(prompt)
+        return template_llm_response(task, prompt)
+
+def local_simplify_criteria(prompt: str) -> str:
+    """Plain-language summary of a simplify prompt built from the structured criteria parser"""
+    inclusion = []
+    exclusion = []
+    for line in prompt.removeprefix("simplify:").splitlines():
+        line = line.strip()
+        if line.startswith("Inclusion:"):
+            inclusion.extend(bullet.strip() for bullet in line.split("Inclusion:", 1)[1].split(";") if bullet.strip())
+        elif line.startswith("Exclusion:"):
+            exclusion.extend(bullet.strip() for bullet in line.split("Exclusion:", 1)[1].split(";") if bullet.strip())
+    
+    criteria_text = "Inclusion Criteria:\n" + "\n".join(f"* {bullet}" for bullet in inclusion)
+    criteria_text += "\nExclusion Criteria:\n" + "\n".join(f"* {bullet}" for bullet in exclusion)
+    parsed = parse_eligibility_criteria(criteria_text)
+    constraints = parsed["constraints"]
+    
+    eligible = []
+    if "age" in constraints:
+        age = constraints["age"]
+        eligible.append(f"are aged {int(age.get('min', 0))} to {int(age['max'])}" if "max" in age else f"are at least {int(age['min'])} years old")
+    if "hba1c" in constraints:
+        hba1c = constraints["hba1c"]
+        eligible.append(f"have an HbA1c between {hba1c.get('min', '-')}% and {hba1c.get('max', '-')}%")
+    if "ecog" in constraints:
+        eligible.append(f"are able to carry out daily activities (ECOG {int(constraints['ecog'].get('max', 4))} or better)")
+    eligible.extend(bullet[:120] for bullet in inclusion[:3])
+    
+    not_eligible = []
+    if parsed["excludes_pregnancy"]:
+        not_eligible.append("are pregnant or breastfeeding")
+    not_eligible.extend(bullet[:120] for bullet in exclusion[:3])
+    
+    if not eligible and not not_eligible:
+        return template_llm_response("simplify", prompt)
+    
+    return (
+        "1. Who might be eligible: you may qualify if you " + ("; ".join(eligible) or "meet the trial's listed conditions") + ".\n"
+        "2. Who might not be eligible: you may not qualify if you " + ("; ".join(not_eligible) or "have conditions the trial excludes") + ".\n"
+        "3. Important considerations: this summary was generated automatically from the listed criteria; "
+        "the study team makes the final eligibility decision."
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_llm_backend():
+    """LLM backend selected by LLM_BACKEND ('openai' or 'local')"""
+    if os.getenv("LLM_BACKEND", "openai") == "local":
+        return LocalRuleBackend(latency_seconds=float(os.getenv("LOCAL_LLM_LATENCY_MS", "0")) / 1000)
+    return OpenAIBackend()
+
+# Circuit breaker: stop waiting on a backend that keeps failing or stalling
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# Successful calls slower than this count towards tripping the breaker like failures
+CIRCUIT_SLOW_CALL_SECONDS = float(os.getenv("CIRCUIT_SLOW_CALL_SECONDS", "15"))
+# Seconds an open breaker waits before letting a probe call through
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+class CircuitBreaker:
+    """Per-backend circuit breaker: closed, open after consecutive failures or slow calls, half-open to probe recovery"""
+
+    def __init__(self, failure_threshold: int, slow_call_seconds: float, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._circuits = {}
+
+    def _circuit(self, name: str) -> Dict[str, Any]:
+        return self._circuits.setdefault(name, {
+            "state": "closed", "consecutive_failures": 0, "opened_at": 0, "probe_started": 0,
+            "trips": 0, "rejected": 0, "last_error": ""
+        })
+
+    def allow(self, name: str) -> bool:
+        """Whether a call may go to the backend; an open circuit lets one probe through every reset period"""
+        with self._lock:
+            circuit = self._circuit(name)
+            if circuit["state"] == "closed":
+                return True
+            now = time.time()
+            # A probe that never reported back (e.g. it lost a rate limit wait) frees the slot after a reset period
+            if now - max(circuit["opened_at"], circuit["probe_started"]) >= self.reset_seconds:
+                circuit["state"] = "half_open"
+                circuit["probe_started"] = now
+                return True
+            circuit["rejected"] += 1
+            return False
+
+    def record(self, name: str, seconds: float, ok: bool, error: str = ""):
+        """Record a backend call; successes close the circuit, failures and slow calls count towards opening it"""
+        with self._lock:
+            circuit = self._circuit(name)
+            if ok and seconds <= self.slow_call_seconds:
+                circuit["state"] = "closed"
+                circuit["consecutive_failures"] = 0
+                return
+            circuit["consecutive_failures"] += 1
+            circuit["last_error"] = error or f"slow call ({seconds:.1f}s)"
+            if circuit["state"] == "half_open" or circuit["consecutive_failures"] >= self.failure_threshold:
+                if circuit["state"] != "open":
+                    circuit["trips"] += 1
+                circuit["state"] = "open"
+                circuit["opened_at"] = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """State, trips and rejected calls per backend for the metrics panel"""
+        with self._lock:
+            return {
+                name: {
+                    "state": circuit["state"],
+                    "consecutive_failures": circuit["consecutive_failures"],
+                    "trips": circuit["trips"],
+                    "rejected": circuit["rejected"],
+                    "seconds_until_probe": round(max(self.reset_seconds - (time.time() - circuit["opened_at"]), 0), 1) if circuit["state"] == "open" else 0,
+                    "last_error": circuit["last_error"]
+                }
+                for name, circuit in self._circuits.items()
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_circuit_breaker():
+    """Process-wide circuit breaker for the LLM backends"""
+    return CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_SLOW_CALL_SECONDS, CIRCUIT_RESET_SECONDS)
+
+# Request deadline: every search gets an end-to-end budget that optional steps give way to
+SEARCH_BUDGET_SECONDS = float(os.getenv("SEARCH_BUDGET_SECONDS", "20"))
+# Below this remaining budget LLM steps only use cached answers or templates
+MIN_LLM_BUDGET_SECONDS = 2
+# Below this remaining budget the refinement steps are skipped
+MIN_REFINEMENT_SECONDS = 1
+
+def start_request(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Start a search's deadline and clear what the previous search degraded"""
+    state["deadline"] = time.time() + SEARCH_BUDGET_SECONDS
+    state["degraded"] = []
+    return state
+
+def remaining_budget(state: Dict[str, Any]):
+    """Seconds left before the search's deadline, or None when it has no deadline"""
+    deadline = state.get("deadline")
+    if not deadline:
+        return None
+    return max(deadline - time.time(), 0.0)
+
+def llm_route_budget(task_budget: float, deadline: float = None) -> float:
+    """Timeout for one LLM route: the task's budget, capped by what is left of the request deadline"""
+    if not deadline:
+        return task_budget
+    return min(task_budget, deadline - time.time())
+
+def rate_limited_complete(backend: LLMBackend, task: str, prompt: str, model_name: str, timeout: float) -> str:
+    """Wait for the model's rate limit within the task budget, then complete with the remaining time"""
+    started = time.monotonic()
+    # A route that cannot get a token within budget fails over like a slow one
+    get_rate_limiter().acquire(f"{backend.name}:{model_name}", timeout=timeout)
+    # Only the backend call itself feeds the circuit breaker, not waits on our own rate limit
+    called = time.monotonic()
+    try:
+        content = backend.complete(task, prompt, model_name, max(timeout - (called - started), 0.1))
     except Exception as e:
-        st.error(f"Error calling Ollama LLM: {str(e)}")
-        # Fallback to simple responses
-        if "clarify" in prompt.lower():
-            return "Could you please specify the type of cancer? For example: 'breast cancer', 'lung cancer', 'melanoma', etc."
-        elif "simplify" in prompt.lower():
-            return "Based on the trial criteria, you may be eligible if you: are 18 years or older, have been diagnosed with the condition, and are in generally good health. You may not be eligible if you: are pregnant, have certain other medical conditions, or are taking specific medications."
-        else:
-            return "I understand you're looking for clinical trials. Let me help you find relevant information."
+        get_circuit_breaker().record(backend.name, time.monotonic() - called, ok=False, error=str(e))
+        raise
+    get_circuit_breaker().record(backend.name, time.monotonic() - called, ok=True)
+    return content
+
+async def async_rate_limited_complete(backend: LLMBackend, task: str, prompt: str, model_name: str, timeout: float) -> str:
+    """Async variant of rate_limited_complete"""
+    started = time.monotonic()
+    await get_rate_limiter().aacquire(f"{backend.name}:{model_name}", timeout=timeout)
+    called = time.monotonic()
+    try:
+        content = await backend.acomplete(task, prompt, model_name, max(timeout - (called - started), 0.1))
+    except Exception as e:
+        get_circuit_breaker().record(backend.name, time.monotonic() - called, ok=False, error=str(e))
+        raise
+    get_circuit_breaker().record(backend.name, time.monotonic() - called, ok=True)
+    return content
+
+# Real LLM function using the configured backend
+def real_llm(prompt: str, model_name: str = "gpt-3.5-turbo", task: str = None, deadline: float = None, degraded: List[str] = None) -> str:
+    """Real LLM function using the configured backend, routed by task
+
+    Routes never run past the request deadline; template fallbacks are noted in degraded.
+    """
+    task = task or detect_llm_task(prompt)
+    task_budget = LLM_TASK_ROUTES.get(task, LLM_TASK_ROUTES["general"])["budget_seconds"]
+    stats = get_llm_latency_stats()
+    backend = get_llm_backend()
+    out_of_time = False
+    circuit_open = False
+    
+    for candidate, route_model in plan_llm_routes(task, model_name):
+        if candidate == "template":
+            break
+        
+        # Repeated prompts (e.g. criteria of unchanged trials) are answered from the cache
+        cache_key = ("llm", backend.name, route_model, task, prompt_hash(prompt))
+        llm_cache = get_llm_cache()
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        budget_seconds = llm_route_budget(task_budget, deadline)
+        if budget_seconds < MIN_LLM_BUDGET_SECONDS:
+            # Too little time left for a call: later routes may still have a cached answer
+            out_of_time = True
+            continue
+        
+        # While the backend's circuit is open, only cached answers are served
+        if not get_circuit_breaker().allow(backend.name):
+            circuit_open = True
+            continue
+        
+        started = time.time()
+        try:
+            # Identical concurrent prompts to the same model share one completion
+            content = get_single_flight().do(cache_key, rate_limited_complete, backend, task, prompt, route_model, budget_seconds)
+            stats.record(task, route_model, time.time() - started, ok=True)
+            llm_cache.set(cache_key, content)
+            return content
+            
+        except Exception as e:
+            # Timeouts and errors fall back to the next route
+            stats.record(task, route_model, time.time() - started, ok=False)
+            st.error(f"Error calling {backend.name} LLM ({route_model}): {str(e)}")
+    
+    if degraded is not None:
+        reason = "deadline reached" if out_of_time else "LLM circuit open" if circuit_open else "LLM unavailable or slow"
+        degraded.append(f"{task}: template answer ({reason})")
+    return template_llm_response(task, prompt)
+
+# Async variant of real_llm for the async graph
+async def async_real_llm(prompt: str, model_name: str = "gpt-3.5-turbo", task: str = None, deadline: float = None, degraded: List[str] = None) -> str:
+    """Same routing, caching, deadline and fallback as real_llm without blocking the event loop"""
+    task = task or detect_llm_task(prompt)
+    task_budget = LLM_TASK_ROUTES.get(task, LLM_TASK_ROUTES["general"])["budget_seconds"]
+    stats = get_llm_latency_stats()
+    backend = get_llm_backend()
+    out_of_time = False
+    circuit_open = False
+    
+    for candidate, route_model in plan_llm_routes(task, model_name):
+        if candidate == "template":
+            break
+        
+        cache_key = ("llm", backend.name, route_model, task, prompt_hash(prompt))
+        llm_cache = get_llm_cache()
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        budget_seconds = llm_route_budget(task_budget, deadline)
+        if budget_seconds < MIN_LLM_BUDGET_SECONDS:
+            out_of_time = True
+            continue
+        
+        # While the backend's circuit is open, only cached answers are served
+        if not get_circuit_breaker().allow(backend.name):
+            circuit_open = True
+            continue
+        
+        started = time.time()
+        try:
+            content = await get_async_single_flight().do(cache_key, async_rate_limited_complete, backend, task, prompt, route_model, budget_seconds)
+            stats.record(task, route_model, time.time() - started, ok=True)
+            llm_cache.set(cache_key, content)
+            return content
+            
+        except Exception as e:
+            stats.record(task, route_model, time.time() - started, ok=False)
+            st.error(f"Error calling {backend.name} LLM ({route_model}): {str(e)}")
+    
+    if degraded is not None:
+        reason = "deadline reached" if out_of_time else "LLM circuit open" if circuit_open else "LLM unavailable or slow"
+        degraded.append(f"{task}: template answer ({reason})")
+    return template_llm_response(task, prompt)
 
 # Node functions for LangGraph
+def needs_clarification(disease: str) -> bool:
+    """Whether a disease input is too vague to search for"""
+    # Simple rules for ambiguous terms
+    ambiguous_terms = ["cancer", "tumor", "disease", "condition", "illness"]
+    return any(term in disease for term in ambiguous_terms) and len(disease.split()) <= 2
+
 def clarify_disease(state: AgentState) -> AgentState:
     """Check if disease input needs clarification"""
     disease = state.get("disease_name", "").lower()
     selected_model = state.get("selected_model", "gpt-3.5-turbo")
     
-    # Simple rules for ambiguous terms
-    ambiguous_terms = ["cancer", "tumor", "disease", "condition", "illness"]
-    
-    if any(term in disease for term in ambiguous_terms) and len(disease.split()) <= 2:
+    if needs_clarification(disease):
         state["needs_clarification"] = True
         # Use real LLM for better clarification
         clarification_prompt = f"clarify: {disease}"
-        state["clarification_question"] = real_llm(clarification_prompt, selected_model)
+        state["clarification_question"] = real_llm(clarification_prompt, selected_model, task="clarify", deadline=state.get("deadline"), degraded=state.setdefault("degraded", []))
         state["messages"].append(AIMessage(content=state["clarification_question"]))
     else:
         state["needs_clarification"] = False
     
     return state
 
-def search_clinical_trials(state: AgentState) -> AgentState:
-    """Search ClinicalTrials.gov API"""
-    disease = state.get("disease_name", "")
+async def async_clarify_disease(state: AgentState) -> AgentState:
+    """Async variant of clarify_disease"""
+    disease = state.get("disease_name", "").lower()
+    selected_model = state.get("selected_model", "gpt-3.5-turbo")
+    
+    if needs_clarification(disease):
+        state["needs_clarification"] = True
+        state["clarification_question"] = await async_real_llm(f"clarify: {disease}", selected_model, task="clarify", deadline=state.get("deadline"), degraded=state.setdefault("degraded", []))
+        state["messages"].append(AIMessage(content=state["clarification_question"]))
+    else:
+        state["needs_clarification"] = False
     
-    if not disease:
+    return state
+
+# ClinicalTrials.gov studies endpoint
+TRIALS_API_URL = "https://clinicaltrials.gov/api/v2/studies"
+
+# Search radius in miles pushed to the API for each travel preference
+TRAVEL_RADIUS_MILES = {
+    "local": 25,
+    "regional": 200
+}
+
+def build_search_filters(user_profile: Dict[str, Any]) -> Dict[str, str]:
+    """Translate the user profile into server-side ClinicalTrials.gov query filters"""
+    if not user_profile:
+        return {}
+    
+    filters = {}
+    advanced = []
+    
+    # Sex: trials open to everyone or to the user's sex
+    user_gender = user_profile.get("gender", "All")
+    if user_gender in ["Male", "Female"]:
+        advanced.append(f"AREA[Sex](ALL OR {user_gender.upper()})")
+    
+    # Age band: minimum age at or below the user's age, maximum age at or above it
+    user_age = user_profile.get("age")
+    if user_age:
+        advanced.append(f"AREA[MinimumAge]RANGE[MIN, {int(user_age)} years]")
+        advanced.append(f"AREA[MaximumAge]RANGE[{int(user_age)} years, MAX]")
+    
+    # Phases the user explicitly restricted to
+    phases = user_profile.get("phases", [])
+    if phases:
+        advanced.append(f"AREA[Phase]({' OR '.join(phases)})")
+    
+    if advanced:
+        filters["filter.advanced"] = " AND ".join(advanced)
+    
+    # Location: geo radius for local/regional travel, country for national travel
+    user_location = user_profile.get("location", "")
+    travel_preference = user_profile.get("travel_preference", "local")
+    if user_location and travel_preference != "international":
+        location_parts = [part.strip() for part in user_location.split(",") if part.strip()]
+        city = location_parts[0] if location_parts else ""
+        country = location_parts[-1] if len(location_parts) > 1 else ""
+        coordinates = get_city_coordinates(city, country)
+        
+        if travel_preference in TRAVEL_RADIUS_MILES and coordinates:
+            filters["filter.geo"] = f"distance({coordinates['lat']},{coordinates['lon']},{TRAVEL_RADIUS_MILES[travel_preference]}mi)"
+        elif travel_preference == "national" and country:
+            filters["query.locn"] = country
+        elif city:
+            # Location we cannot geocode: fall back to matching the place name
+            filters["query.locn"] = city
+    
+    return filters
+
+TRIALS_REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# Fields the list stage needs for ranking, risk, charts and cards; full records are loaded per trial on demand
+TRIALS_SUMMARY_FIELDS = [
+    "NCTId", "BriefTitle", "OverallStatus", "StudyFirstPostDate", "LastUpdatePostDate", "Condition",
+    "LeadSponsorName", "LeadSponsorClass",
+    "Phase", "StudyType", "DesignInterventionModel", "DesignAllocation", "EnrollmentCount",
+    # Criteria text is loaded by the criteria stage, only for the trials whose criteria are read
+    "Sex", "MinimumAge", "MaximumAge", "StdAge", "HealthyVolunteers",
+    # Sites stay: distance scoring, maps, the quality check and exports read every trial's sites
+    "LocationFacility", "LocationCity", "LocationState", "LocationCountry"
+]
+
+# Trials kept per search: the first page of results
+TRIALS_PAGE_SIZE = 50
+
+def trials_request_params(disease: str, filters: Dict[str, str] = None, updated_since: str = None) -> Dict[str, Any]:
+    """Query parameters for a recruiting-trials search or a change-feed request"""
+    params = {
+        "query.cond": disease,
+        "filter.overallStatus": "RECRUITING",
+        "pageSize": TRIALS_PAGE_SIZE,
+        # totalCount is only returned when asked for
+        "countTotal": "true",
+        "fields": ",".join(TRIALS_SUMMARY_FIELDS),
+        **(filters or {})
+    }
+    if updated_since:
+        # Change feed: every trial updated since the date, including ones that stopped recruiting
+        update_filter = f"AREA[LastUpdatePostDate]RANGE[{updated_since}, MAX]"
+        params["filter.advanced"] = f"{params['filter.advanced']} AND {update_filter}" if params.get("filter.advanced") else update_filter
+        params["pageSize"] = 1000
+        del params["filter.overallStatus"]
+    return params
+
+# Pages requested with at least this many studies are parsed incrementally when ijson is installed
+STREAM_PARSE_MIN_PAGE_SIZE = 200
+
+def decode_json(content: bytes):
+    """Decode a JSON response body with orjson when installed, else the standard library"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def process_trials_page(page: Dict[str, Any]) -> Dict[str, Any]:
+    """Processed studies plus the paging fields of a decoded studies page"""
+    studies = [process_study(study) for study in page.get("studies", [])]
+    return {
+        "studies": studies,
+        "totalCount": page.get("totalCount", len(studies)),
+        "nextPageToken": page.get("nextPageToken")
+    }
+
+def stream_trials_page(stream) -> Dict[str, Any]:
+    """Parse a studies page from a byte stream, processing each study as soon as it is complete"""
+    page = {"studies": [], "totalCount": None, "nextPageToken": None}
+    builder = None
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            # Only one raw study is held at a time; it is dropped once processed
+            if prefix == "studies.item" and event == "end_map":
+                page["studies"].append(process_study(builder.value))
+                builder = None
+        elif prefix == "studies.item" and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix in ("totalCount", "nextPageToken"):
+            page[prefix] = value
+    if page["totalCount"] is None:
+        page["totalCount"] = len(page["studies"])
+    return page
+
+def fetch_trials(disease: str, filters: Dict[str, str] = None, updated_since: str = None) -> Dict[str, Any]:
+    """Fetch recruiting trials for a condition from ClinicalTrials.gov, returning processed studies"""
+    # Let requests encode the query and filter parameters
+    params = trials_request_params(disease, filters, updated_since)
+    stream = ijson is not None and params["pageSize"] >= STREAM_PARSE_MIN_PAGE_SIZE
+    get_rate_limiter().acquire("trials", timeout=TRIALS_RATE_LIMIT_WAIT_SECONDS)
+    response = requests.get(TRIALS_API_URL, params=params, headers=TRIALS_REQUEST_HEADERS, timeout=30, stream=stream)
+    response.raise_for_status()
+    if stream:
+        with response:
+            response.raw.decode_content = True
+            return stream_trials_page(response.raw)
+    return process_trials_page(decode_json(response.content))
+
+async def async_fetch_trials(client: httpx.AsyncClient, disease: str, filters: Dict[str, str] = None, updated_since: str = None) -> Dict[str, Any]:
+    """Async variant of fetch_trials over a shared HTTP client"""
+    params = trials_request_params(disease, filters, updated_since)
+    await get_rate_limiter().aacquire("trials", timeout=TRIALS_RATE_LIMIT_WAIT_SECONDS)
+    response = await client.get(TRIALS_API_URL, params=params, headers=TRIALS_REQUEST_HEADERS, timeout=30)
+    response.raise_for_status()
+    return process_trials_page(decode_json(response.content))
+
+def fetch_trial_record(nct_id: str) -> Dict[str, Any]:
+    """Fetch the full record of one trial from the single-study endpoint"""
+    get_rate_limiter().acquire("trials", timeout=TRIALS_RATE_LIMIT_WAIT_SECONDS)
+    response = requests.get(f"{TRIALS_API_URL}/{nct_id}", headers=TRIALS_REQUEST_HEADERS, timeout=30)
+    response.raise_for_status()
+    return decode_json(response.content)
+
+def process_study_details(study: Dict[str, Any]) -> Dict[str, Any]:
+    """Processed study plus the detail-only sections shown when a trial is opened"""
+    protocol = study.get("protocolSection", {})
+    return {
+        **process_study(study),
+        # Full site list with contacts for the detail view
+        "locationsModule": protocol.get("contactsLocationsModule", {}),
+        "descriptionModule": protocol.get("descriptionModule", {}),
+        "armsInterventionsModule": protocol.get("armsInterventionsModule", {})
+    }
+
+@st.cache_resource(show_spinner=False)
+def get_detail_cache():
+    """Process-wide cache of full trial records"""
+    return ResponseCache(max_entries=1024, ttl_seconds=float(os.getenv("TRIALS_CACHE_TTL_SECONDS", "900")))
+
+def get_trial_details(nct_id: str, last_update: str = "") -> Dict[str, Any]:
+    """Full record of one trial, cached per nctId and last update date"""
+    cache = get_detail_cache()
+    cache_key = ("details", nct_id, last_update)
+    details = cache.get(cache_key)
+    if details is None:
+        details = get_single_flight().do(cache_key, lambda: process_study_details(fetch_trial_record(nct_id)))
+        cache.set(cache_key, details)
+    return details
+
+# Criteria stage: eligibility text is loaded in batches for just the trials whose criteria are read,
+# the ones the summary covers, or every trial when the profile is checked against criteria text
+CRITERIA_BATCH_SIZE = 100
+
+def fetch_trial_criteria(nct_ids: List[str], timeout: float = 30) -> Dict[str, str]:
+    """Eligibility criteria text of specific trials, fetched in one request"""
+    params = {"filter.ids": ",".join(nct_ids), "pageSize": len(nct_ids), "fields": "NCTId,EligibilityCriteria"}
+    get_rate_limiter().acquire("trials", timeout=TRIALS_RATE_LIMIT_WAIT_SECONDS)
+    response = requests.get(TRIALS_API_URL, params=params, headers=TRIALS_REQUEST_HEADERS, timeout=timeout)
+    response.raise_for_status()
+    criteria = {}
+    for study in decode_json(response.content).get("studies", []):
+        protocol = study.get("protocolSection", {})
+        criteria[protocol.get("identificationModule", {}).get("nctId", "")] = protocol.get("eligibilityModule", {}).get("eligibilityCriteria", "")
+    return criteria
+
+@st.cache_resource(show_spinner=False)
+def get_trial_criteria_cache():
+    """Process-wide cache of parsed trial criteria keyed by nctId and last update date"""
+    return ResponseCache(max_entries=5000, ttl_seconds=float(os.getenv("TRIALS_CACHE_TTL_SECONDS", "900")))
+
+def criteria_loaded(study: Dict[str, Any]) -> bool:
+    """Whether a study carries its eligibility criteria text"""
+    return "eligibilityCriteria" in study.get("eligibilityModule", {})
+
+def with_criteria(studies: List[Dict[str, Any]], limit: int = None, timeout: float = 30) -> List[Dict[str, Any]]:
+    """Studies with criteria text and parsed criteria loaded for the first limit of them, or all when limit is None"""
+    cache = get_trial_criteria_cache()
+    loaded = {}
+    missing = []
+    for study in (studies if limit is None else studies[:limit]):
+        if criteria_loaded(study):
+            continue
+        criteria = cache.get(("criteria", study.get("nctId", ""), study.get("lastUpdatePostDate", "")))
+        if criteria is None:
+            missing.append(study)
+        else:
+            loaded[study.get("nctId", "")] = criteria
+    
+    for start in range(0, len(missing), CRITERIA_BATCH_SIZE):
+        batch = missing[start:start + CRITERIA_BATCH_SIZE]
+        texts = fetch_trial_criteria([study.get("nctId", "") for study in batch], timeout=timeout)
+        for study in batch:
+            text = texts.get(study.get("nctId", ""), "")
+            criteria = {"eligibilityCriteria": text, "parsedCriteria": parse_eligibility_criteria(text)}
+            cache.set(("criteria", study.get("nctId", ""), study.get("lastUpdatePostDate", "")), criteria)
+            loaded[study.get("nctId", "")] = criteria
+    
+    # Copies, so cached and stored result sets are never modified
+    return [
+        {
+            **study,
+            "eligibilityModule": {**study.get("eligibilityModule", {}), "eligibilityCriteria": loaded[study["nctId"]]["eligibilityCriteria"]},
+            "parsedCriteria": loaded[study["nctId"]]["parsedCriteria"]
+        } if study.get("nctId", "") in loaded else study
+        for study in studies
+    ]
+
+def load_criteria(state: AgentState, limit: int = None) -> List[Dict[str, Any]]:
+    """Load the criteria of the first limit trials (all when None) into api_results and return its studies
+
+    A failed or late criteria request leaves the trials without criteria and is reported as a degraded step.
+    """
+    api_results = state.get("api_results", {})
+    studies = api_results.get("studies", [])
+    budget = remaining_budget(state)
+    try:
+        studies = with_criteria(studies, limit, timeout=30 if budget is None else max(min(budget, 30), MIN_REFINEMENT_SECONDS))
+    except Exception as e:
+        state.setdefault("degraded", []).append(f"criteria: not loaded ({str(e)})")
+        return studies
+    state["api_results"] = {**api_results, "studies": studies}
+    return studies
+
+LOCATION_FIELDS = ["facility", "city", "state", "country"]
+
+def process_study(study: Dict[str, Any]) -> Dict[str, Any]:
+    """Extract the fields the app uses from a raw API study record"""
+    protocol = study.get("protocolSection", {})
+    identification = protocol.get("identificationModule", {})
+    status = protocol.get("statusModule", {})
+    conditions = protocol.get("conditionsModule", {})
+    sponsor = protocol.get("sponsorCollaboratorsModule", {})
+    locations = protocol.get("contactsLocationsModule", {})
+    design = protocol.get("designModule", {})
+    eligibility = protocol.get("eligibilityModule", {})
+    
+    return {
+        "nctId": identification.get("nctId", ""),
+        "briefTitle": identification.get("briefTitle", ""),
+        "overallStatus": status.get("overallStatus", ""),
+        "studyFirstPostDate": status.get("studyFirstPostDateStruct", {}).get("date", ""),
+        "lastUpdatePostDate": status.get("lastUpdatePostDateStruct", {}).get("date", ""),
+        "conditionModule": {
+            "conditions": conditions.get("conditions", [])
+        },
+        "sponsorModule": sponsor,
+        # Only the site fields the app reads, so raw site records (contacts, geo points) can be freed
+        "locationsModule": {
+            "locations": [
+                {field: location.get(field, "") for field in LOCATION_FIELDS}
+                for location in locations.get("locations", [])
+            ]
+        },
+        "designModule": design,
+        "eligibilityModule": eligibility,
+        # Structured criteria for local profile matching; list pages leave them to the criteria stage
+        "parsedCriteria": parse_eligibility_criteria(eligibility.get("eligibilityCriteria", ""))
+    }
+
+def patch_saved_results(results: Dict[str, Any], updates: Dict[str, Any], refreshed_on: str) -> Dict[str, Any]:
+    """Apply a change-feed page to a saved result set, or None when a full refresh is needed"""
+    # Too many changes to fit one page, or the change feed failed: do a full refresh instead
+    if updates is None or updates.get("nextPageToken"):
+        return None
+    
+    studies = {study["nctId"]: study for study in results["studies"]}
+    total_count = results["totalCount"]
+    new_studies = []
+    updated_trials = []
+    for study in updates.get("studies", []):
+        recruiting = study["overallStatus"] == "RECRUITING"
+        if study["nctId"] in studies:
+            # Trials on the saved page are updated in place or dropped when they stop recruiting
+            if recruiting:
+                studies[study["nctId"]] = study
+                updated_trials.append(study["nctId"])
+            else:
+                del studies[study["nctId"]]
+                total_count -= 1
+        elif recruiting and study.get("studyFirstPostDate", "") >= refreshed_on:
+            # Only trials first posted since the last refresh are new to the total; updates to
+            # older trials beyond the saved page were already counted and are not shown
+            new_studies.append(study)
+            updated_trials.append(study["nctId"])
+            total_count += 1
+    
+    # New trials go first; the saved set stays one page long
+    studies = (new_studies + list(studies.values()))[:TRIALS_PAGE_SIZE]
+    kept = {study["nctId"] for study in studies}
+    # The total can never be below the trials kept, e.g. for result sets saved without a totalCount
+    total_count = max(total_count, len(studies))
+    return {"studies": studies, "totalCount": total_count, "updatedTrials": [nct_id for nct_id in updated_trials if nct_id in kept]}
+
+def full_results(page: Dict[str, Any]) -> Dict[str, Any]:
+    """Result set from a full search page"""
+    return {
+        "studies": page["studies"],
+        "totalCount": page["totalCount"],
+        "updatedTrials": []
+    }
+
+def load_condition_results(query: str, filters: Dict[str, str], saved_searches) -> Dict[str, Any]:
+    """Fetch and process the trials for one normalized condition, patching a saved result set when there is one"""
+    saved_key = result_hash(search_key(query, filters))
+    today = datetime.now(timezone.utc).date().isoformat()
+    saved = saved_searches.load(saved_key)
+    
+    if saved:
+        refreshed_on, results = saved
+        try:
+            updates = fetch_trials(query, filters, updated_since=refreshed_on)
+        except Exception:
+            updates = None
+        
+        results = patch_saved_results(results, updates, refreshed_on)
+        if results is not None:
+            saved_searches.save(saved_key, today, results)
+            return results
+    
+    results = full_results(fetch_trials(query, filters))
+    saved_searches.save(saved_key, today, results)
+    return results
+
+async def async_load_condition_results(client: httpx.AsyncClient, query: str, filters: Dict[str, str], saved_searches) -> Dict[str, Any]:
+    """Async variant of load_condition_results"""
+    saved_key = result_hash(search_key(query, filters))
+    today = datetime.now(timezone.utc).date().isoformat()
+    saved = saved_searches.load(saved_key)
+    
+    if saved:
+        refreshed_on, results = saved
+        try:
+            updates = await async_fetch_trials(client, query, filters, updated_since=refreshed_on)
+        except Exception:
+            updates = None
+        
+        results = patch_saved_results(results, updates, refreshed_on)
+        if results is not None:
+            saved_searches.save(saved_key, today, results)
+            return results
+    
+    results = full_results(await async_fetch_trials(client, query, filters))
+    saved_searches.save(saved_key, today, results)
+    return results
+
+def get_condition_results(query: str, filters: Dict[str, str], cache, single_flight, saved_searches, refresh: bool = False) -> Dict[str, Any]:
+    """Processed results for one condition, from the response cache or a coalesced upstream fetch"""
+    cache_key = ("trials", search_key(query, filters))
+    results = None if refresh else cache.get(cache_key)
+    if results is None:
+        results = single_flight.do(cache_key, load_condition_results, query, filters, saved_searches)
+        cache.set(cache_key, results)
+    return results
+
+async def async_get_condition_results(client: httpx.AsyncClient, query: str, filters: Dict[str, str], cache, single_flight, saved_searches) -> Dict[str, Any]:
+    """Async variant of get_condition_results"""
+    cache_key = ("trials", search_key(query, filters))
+    results = cache.get(cache_key)
+    if results is None:
+        results = await single_flight.do(cache_key, async_load_condition_results, client, query, filters, saved_searches)
+        cache.set(cache_key, results)
+    return results
+
+# Canonical names for common abbreviations and spelling variants of conditions
+QUERY_SYNONYMS = {
+    "t1d": "type 1 diabetes",
+    "t1dm": "type 1 diabetes",
+    "type i diabetes": "type 1 diabetes",
+    "type one diabetes": "type 1 diabetes",
+    "t2d": "type 2 diabetes",
+    "t2dm": "type 2 diabetes",
+    "type ii diabetes": "type 2 diabetes",
+    "type two diabetes": "type 2 diabetes",
+    "ckd": "chronic kidney disease",
+    "copd": "chronic obstructive pulmonary disease",
+    "nsclc": "non-small cell lung cancer",
+    "non small cell lung cancer": "non-small cell lung cancer",
+    "sclc": "small cell lung cancer",
+    "breast carcinoma": "breast cancer",
+    "ms": "multiple sclerosis",
+    "als": "amyotrophic lateral sclerosis",
+    "afib": "atrial fibrillation",
+    "a-fib": "atrial fibrillation",
+    "heart attack": "myocardial infarction",
+    "high blood pressure": "hypertension",
+    # Full names map to themselves so the shorter forms below never double the word "disease"
+    "alzheimer's disease": "alzheimer's disease",
+    "alzheimers disease": "alzheimer's disease",
+    "alzheimers": "alzheimer's disease",
+    "alzheimer's": "alzheimer's disease",
+    "parkinson's disease": "parkinson's disease",
+    "parkinsons disease": "parkinson's disease",
+    "parkinsons": "parkinson's disease",
+    "parkinson's": "parkinson's disease"
+}
+# Longest phrases first so "type ii diabetes" wins over shorter overlaps
+QUERY_SYNONYM_PATTERN = re.compile(
+    r"(?<![\w'-])(" + "|".join(re.escape(term) for term in sorted(QUERY_SYNONYMS, key=len, reverse=True)) + r")(?![\w'-])"
+)
+QUERY_PUNCTUATION_PATTERN = re.compile(r"[^\w\s'+-]")
+
+def normalize_query(condition: str) -> str:
+    """Canonical form of a condition: Unicode, case, punctuation, whitespace and synonym folding"""
+    condition = unicodedata.normalize("NFKC", condition).casefold()
+    condition = condition.replace("’", "'").replace("&", " and ")
+    condition = QUERY_PUNCTUATION_PATTERN.sub(" ", condition)
+    condition = " ".join(condition.split()).strip("'-+ ")
+    return QUERY_SYNONYM_PATTERN.sub(lambda match: QUERY_SYNONYMS[match.group(1)], condition)
+
+def search_key(query: str, filters: Dict[str, str]) -> str:
+    """Stable key for a normalized condition and its server-side filters"""
+    return json.dumps([query, filters], sort_keys=True)
+
+def split_conditions(disease: str) -> List[str]:
+    """Split a multi-condition query like 'type 2 diabetes, CKD' into normalized, unique conditions"""
+    conditions = []
+    for condition in re.split(r"[,;]", disease):
+        # Normalize so equivalent searches share cache entries and requests
+        condition = normalize_query(condition)
+        if condition and condition not in conditions:
+            conditions.append(condition)
+    return conditions[:MAX_SEARCH_CONDITIONS]
+
+def plan_search(state: AgentState):
+    """Normalized conditions and server-side filters for a search, or None when there is nothing to search"""
+    conditions = split_conditions(state.get("disease_name", ""))
+    
+    if not conditions:
         state["messages"].append(AIMessage(content="Please provide a disease or condition to search for."))
+        return None
+    
+    # Push profile filters to the API so only trials that can match are transferred
+    filters = build_search_filters(state.get("user_profile", {}))
+    
+    query_log = get_query_log()
+    for condition in conditions:
+        query_log.record(condition, filters)
+    
+    return conditions, filters
+
+def search_clinical_trials(state: AgentState) -> AgentState:
+    """Search ClinicalTrials.gov API"""
+    plan = plan_search(state)
+    if plan is None:
         return state
+    conditions, filters = plan
     
-    # Construct API query - using direct URL to avoid encoding issues
-    url = f"https://clinicaltrials.gov/api/v2/studies?query.cond={disease}&filter.overallStatus=RECRUITING&pageSize=50"
+    cache = get_response_cache()
+    single_flight = get_single_flight()
+    saved_searches = get_saved_search_store()
     
+    # Fan out one request per condition; each condition hits the cache independently
+    condition_results = {}
+    errors = []
+    pool = ThreadPoolExecutor(max_workers=len(conditions))
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        futures = {
+            # Copy the context so fetches are rate limited under this session
+            condition: pool.submit(contextvars.copy_context().run, get_condition_results, condition, filters, cache, single_flight, saved_searches)
+            for condition in conditions
         }
-        response = requests.get(url, headers=headers, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        
-        # Process the API response to extract the actual studies
-        studies = data.get("studies", [])
-        processed_studies = []
-        
-        for study in studies:
-            protocol = study.get("protocolSection", {})
-            identification = protocol.get("identificationModule", {})
-            status = protocol.get("statusModule", {})
-            conditions = protocol.get("conditionsModule", {})
-            sponsor = protocol.get("sponsorCollaboratorsModule", {})
-            locations = protocol.get("contactsLocationsModule", {})
-            design = protocol.get("designModule", {})
-            eligibility = protocol.get("eligibilityModule", {})
-            
-            processed_study = {
-                "nctId": identification.get("nctId", ""),
-                "briefTitle": identification.get("briefTitle", ""),
-                "overallStatus": status.get("overallStatus", ""),
-                "conditionModule": {
-                    "conditions": conditions.get("conditions", [])
-                },
-                "sponsorModule": sponsor,
-                "locationsModule": locations,
-                "designModule": design,
-                "eligibilityModule": eligibility
-            }
-            processed_studies.append(processed_study)
-        
-        # Update the data with processed studies
-        data["studies"] = processed_studies
-        state["api_results"] = data
-        state["messages"].append(AIMessage(content=f"Found {len(processed_studies)} recruiting trials for {disease}."))
-        
-    except Exception as e:
-        state["messages"].append(AIMessage(content=f"Error searching for trials: {str(e)}"))
+        for condition, future in futures.items():
+            try:
+                condition_results[condition] = future.result(timeout=remaining_budget(state))
+            except FutureTimeoutError:
+                # Past the deadline: stop waiting; the fetch still completes and fills the cache
+                errors.append(f"{condition}: timed out")
+                state.setdefault("degraded", []).append(f"search: '{condition}' timed out")
+            except Exception as e:
+                errors.append(f"{condition}: {str(e)}")
+    finally:
+        pool.shutdown(wait=False)
+    
+    return merge_search_results(state, conditions, filters, condition_results, errors)
+
+async def async_search_clinical_trials(state: AgentState) -> AgentState:
+    """Async variant of search_clinical_trials: conditions are fetched concurrently on the event loop"""
+    plan = plan_search(state)
+    if plan is None:
+        return state
+    conditions, filters = plan
+    
+    cache = get_response_cache()
+    single_flight = get_async_single_flight()
+    saved_searches = get_saved_search_store()
+    
+    async with httpx.AsyncClient() as client:
+        outcomes = await asyncio.gather(
+            *(
+                asyncio.wait_for(async_get_condition_results(client, condition, filters, cache, single_flight, saved_searches), timeout=remaining_budget(state))
+                for condition in conditions
+            ),
+            return_exceptions=True
+        )
+    
+    condition_results = {}
+    errors = []
+    for condition, outcome in zip(conditions, outcomes):
+        if isinstance(outcome, asyncio.TimeoutError):
+            # Unlike the threaded search, the fetch is abandoned: its client closes here and the loop ends with the run
+            errors.append(f"{condition}: timed out")
+            state.setdefault("degraded", []).append(f"search: '{condition}' timed out (fetch abandoned)")
+        elif isinstance(outcome, Exception):
+            errors.append(f"{condition}: {str(outcome)}")
+        else:
+            condition_results[condition] = outcome
+    
+    return merge_search_results(state, conditions, filters, condition_results, errors)
+
+def merge_search_results(state: AgentState, conditions: List[str], filters: Dict[str, str], condition_results: Dict[str, Any], errors: List[str]) -> AgentState:
+    """Merge per-condition results into api_results and report what was found"""
+    disease = state.get("disease_name", "")
+    
+    if not condition_results:
+        state["messages"].append(AIMessage(content=f"Error searching for trials: {'; '.join(errors)}"))
         state["api_results"] = {"studies": [], "totalCount": 0}
+        return state
+    
+    # Merge and deduplicate by nctId, tracking which conditions each trial matched
+    merged = {}
+    for condition, results in condition_results.items():
+        for study in results["studies"]:
+            nct_id = study.get("nctId", "")
+            if nct_id in merged:
+                merged[nct_id]["matchedConditions"].append(condition)
+            else:
+                # Copy so the cached study is never modified
+                merged[nct_id] = {**study, "matchedConditions": [condition]}
+    
+    studies = list(merged.values())
+    state["api_results"] = {
+        "studies": studies,
+        "totalCount": sum(results["totalCount"] for results in condition_results.values()),
+        "conditions": list(condition_results),
+        "filters": filters,
+        # Trials new or changed since the saved search was last refreshed
+        "updatedTrials": sorted(set(nct_id for results in condition_results.values() for nct_id in results.get("updatedTrials", [])) & set(merged)),
+        "conditionCounts": {condition: results["totalCount"] for condition, results in condition_results.items()}
+    }
+    
+    if len(conditions) > 1:
+        state["messages"].append(AIMessage(content=f"Found {len(studies)} recruiting trials across {len(condition_results)} conditions: {', '.join(condition_results)}."))
+    else:
+        state["messages"].append(AIMessage(content=f"Found {len(studies)} recruiting trials for {disease}."))
+    if errors:
+        state["messages"].append(AIMessage(content=f"Error searching for some conditions: {'; '.join(errors)}"))
     
     return state
 
+# Near-duplicate criteria: sponsors reuse eligibility text across arms and countries, so similar criteria share a summary
+# Words per shingle when comparing criteria text
+CRITERIA_SHINGLE_WORDS = 3
+# MinHash signature length, split into LSH bands of CRITERIA_LSH_ROWS values each
+CRITERIA_MINHASH_SIZE = 64
+CRITERIA_LSH_ROWS = 4
+# Estimated Jaccard similarity above which a stored summary is reused
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.85"))
+# Most differing criteria listed under a reused summary
+MAX_DIFF_CRITERIA = 5
+
+# Mersenne prime modulus and fixed (a, b) coefficients of the MinHash permutations
+MINHASH_PRIME = (1 << 61) - 1
+MINHASH_PERMUTATIONS = [
+    (int.from_bytes(hashlib.sha256(f"minhash-a-{i}".encode()).digest()[:8], "big") % (MINHASH_PRIME - 1) + 1,
+     int.from_bytes(hashlib.sha256(f"minhash-b-{i}".encode()).digest()[:8], "big") % MINHASH_PRIME)
+    for i in range(CRITERIA_MINHASH_SIZE)
+]
+
+def criteria_shingles(criteria: List[str]) -> set:
+    """Overlapping word shingles of each normalized criterion, so reordered criteria still match"""
+    shingles = set()
+    for criterion in criteria:
+        words = re.findall(r"[a-z0-9]+", criterion.lower())
+        if len(words) <= CRITERIA_SHINGLE_WORDS:
+            shingles.add(" ".join(words))
+        else:
+            shingles.update(" ".join(words[i:i + CRITERIA_SHINGLE_WORDS]) for i in range(len(words) - CRITERIA_SHINGLE_WORDS + 1))
+    shingles.discard("")
+    return shingles
+
+def minhash_signature(shingles: set) -> tuple:
+    """MinHash signature of a shingle set, one minimum per permutation"""
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big") for shingle in shingles]
+    return tuple(min((a * value + b) % MINHASH_PRIME for value in hashes) for a, b in MINHASH_PERMUTATIONS)
+
+class CriteriaIndex:
+    """Thread-safe LRU index of criteria summaries with MinHash LSH lookup of near-duplicate criteria"""
+
+    def __init__(self, threshold: float, max_entries: int = 2048):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def _bands(self, signature: tuple) -> List:
+        return [(start, signature[start:start + CRITERIA_LSH_ROWS]) for start in range(0, len(signature), CRITERIA_LSH_ROWS)]
+
+    def lookup(self, criteria: List[str]):
+        """Closest stored entry whose estimated similarity reaches the threshold, or None"""
+        shingles = criteria_shingles(criteria)
+        if not shingles:
+            return None
+        signature = minhash_signature(shingles)
+        with self._lock:
+            self.lookups += 1
+            # Criteria sharing any whole band are candidates; the signature agreement estimates their Jaccard similarity
+            candidates = set()
+            for band in self._bands(signature):
+                candidates |= self._buckets.get(band, set())
+            best_key, best_similarity = None, 0.0
+            for key in candidates:
+                stored_signature = self._entries[key]["signature"]
+                similarity = sum(1 for left, right in zip(signature, stored_signature) if left == right) / len(signature)
+                if similarity > best_similarity:
+                    best_key, best_similarity = key, similarity
+            if best_key is None or best_similarity < self.threshold:
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            return dict(self._entries[best_key], similarity=best_similarity)
+
+    def add(self, criteria: List[str], summary: str):
+        """Index a summary under its criteria, evicting the least recently used entries beyond max_entries"""
+        shingles = criteria_shingles(criteria)
+        if not shingles:
+            return
+        signature = minhash_signature(shingles)
+        key = prompt_hash("\n".join(sorted(criteria)))
+        with self._lock:
+            if key not in self._entries:
+                for band in self._bands(signature):
+                    self._buckets.setdefault(band, set()).add(key)
+            self._entries[key] = {"signature": signature, "summary": summary, "criteria": criteria}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                for band in self._bands(evicted["signature"]):
+                    bucket = self._buckets.get(band)
+                    if bucket is not None:
+                        bucket.discard(evicted_key)
+                        if not bucket:
+                            del self._buckets[band]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Entries and hit rate for the metrics panel"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "lookups": self.lookups,
+                "near_duplicate_hits": self.hits,
+                "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else 0.0
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_criteria_index():
+    """Process-wide index of simplified criteria for near-duplicate reuse"""
+    return CriteriaIndex(NEAR_DUPLICATE_THRESHOLD)
+
+def criteria_notes(heading: str, criteria: List[str]) -> str:
+    """A bulleted list of criteria under a heading, saying how many were left out"""
+    notes = "\n".join(f"- {criterion}" for criterion in criteria[:MAX_DIFF_CRITERIA])
+    if len(criteria) > MAX_DIFF_CRITERIA:
+        notes += f"\n- ...and {len(criteria) - MAX_DIFF_CRITERIA} more"
+    return f"\n\n{heading}:\n{notes}"
+
+def reuse_criteria_summary(match: Dict[str, Any], criteria: List[str]):
+    """A near-duplicate's summary with the criteria added and removed since, or None when it cannot be reused
+
+    Criteria that differ in a number (age range, lab limit, washout) change what the summary says,
+    so those are simplified afresh.
+    """
+    stored, current = set(match["criteria"]), set(criteria)
+    added = [criterion for criterion in criteria if criterion not in stored]
+    removed = [criterion for criterion in match["criteria"] if criterion not in current]
+    if any(re.search(r"\d", criterion) for criterion in added + removed):
+        return None
+    summary = match["summary"]
+    if added:
+        summary += criteria_notes("These trials also list criteria not covered above", added)
+    if removed:
+        summary += criteria_notes("The summary above was written for similar trials and also covers criteria these trials do not list", removed)
+    return summary
+
 def summarize_eligibility(state: AgentState) -> AgentState:
     """Summarize eligibility criteria using LLM"""
     api_results = state.get("api_results", {})
@@ -456,72 +2347,130 @@ def summarize_eligibility(state: AgentState) -> AgentState:
         state["simplified_criteria"] = "No trials found to analyze eligibility criteria."
         return state
     
-    # Extract eligibility criteria from first few studies
-    criteria_text = ""
-    for study in studies[:3]:  # Look at first 3 studies
-        eligibility = study.get("eligibilityModule", {})
-        if eligibility:
-            inclusion = eligibility.get("inclusionCriteria", "")
-            exclusion = eligibility.get("exclusionCriteria", "")
-            criteria_text += f"Inclusion: {inclusion}\nExclusion: {exclusion}\n\n"
+    # Only the trials the summary covers need their criteria text
+    studies = load_criteria(state, SUMMARY_CRITERIA_TRIALS)
+    
+    # Criteria near-identical to ones already simplified reuse that summary instead of calling the LLM
+    prompt, criteria = eligibility_prompt(studies), eligibility_items(studies)
+    index = get_criteria_index()
+    match = index.lookup(criteria)
+    reused = reuse_criteria_summary(match, criteria) if match else None
+    if reused is not None:
+        state["simplified_criteria"] = reused
+        return state
     
     # Use real LLM to simplify criteria
-    prompt = f"simplify: {criteria_text}"
-    simplified = real_llm(prompt, selected_model)
+    degraded = state.setdefault("degraded", [])
+    fallbacks = len(degraded)
+    simplified = real_llm(prompt, selected_model, task="simplify", deadline=state.get("deadline"), degraded=degraded)
+    # Template fallbacks are not worth sharing
+    if len(degraded) == fallbacks:
+        index.add(criteria, simplified)
     
     state["simplified_criteria"] = simplified
     return state
 
-def prepare_visualizations(state: AgentState) -> AgentState:
-    """Prepare data for visualizations"""
-    api_results = state.get("api_results", {})
-    studies = api_results.get("studies", [])
+async def async_summarize_eligibility(state: AgentState) -> AgentState:
+    """Async variant of summarize_eligibility"""
+    studies = state.get("api_results", {}).get("studies", [])
+    selected_model = state.get("selected_model", "gpt-3.5-turbo")
     
     if not studies:
-        state["visualization_data"] = {}
+        state["simplified_criteria"] = "No trials found to analyze eligibility criteria."
         return state
     
-    # Prepare map data from location information with coordinates
+    studies = await asyncio.to_thread(load_criteria, state, SUMMARY_CRITERIA_TRIALS)
+    prompt, criteria = eligibility_prompt(studies), eligibility_items(studies)
+    index = get_criteria_index()
+    match = index.lookup(criteria)
+    reused = reuse_criteria_summary(match, criteria) if match else None
+    if reused is not None:
+        state["simplified_criteria"] = reused
+        return state
+    
+    degraded = state.setdefault("degraded", [])
+    fallbacks = len(degraded)
+    simplified = await async_real_llm(prompt, selected_model, task="simplify", deadline=state.get("deadline"), degraded=degraded)
+    if len(degraded) == fallbacks:
+        index.add(criteria, simplified)
+    
+    state["simplified_criteria"] = simplified
+    return state
+
+# Trials whose criteria the simplify prompt covers
+SUMMARY_CRITERIA_TRIALS = 3
+
+def eligibility_parsed(studies: List[Dict[str, Any]]) -> List[Dict[str, List[str]]]:
+    """Parsed criteria of the first few studies, the ones the simplify prompt covers"""
+    parsed_criteria = []
+    for study in studies[:SUMMARY_CRITERIA_TRIALS]:
+        parsed = study.get("parsedCriteria") or parse_eligibility_criteria(study.get("eligibilityModule", {}).get("eligibilityCriteria", ""))
+        if parsed["inclusion"] or parsed["exclusion"]:
+            parsed_criteria.append(parsed)
+    return parsed_criteria
+
+def eligibility_items(studies: List[Dict[str, Any]]) -> List[str]:
+    """Distinct labelled criteria covered by the simplify prompt, in order"""
+    items = []
+    for parsed in eligibility_parsed(studies):
+        items += [f"Inclusion: {criterion}" for criterion in parsed["inclusion"]]
+        items += [f"Exclusion: {criterion}" for criterion in parsed["exclusion"]]
+    return list(dict.fromkeys(items))
+
+def eligibility_prompt(studies: List[Dict[str, Any]]) -> str:
+    """Simplify prompt built from the parsed criteria of the first few studies"""
+    criteria_text = ""
+    for parsed in eligibility_parsed(studies):
+        inclusion = "; ".join(parsed["inclusion"])
+        exclusion = "; ".join(parsed["exclusion"])
+        criteria_text += f"Inclusion: {inclusion}\nExclusion: {exclusion}\n\n"
+    return f"simplify: {criteria_text}"
+
+# Map ClinicalTrials.gov phase codes to readable names
+PHASE_LABELS = {
+    "PHASE1": "Phase 1",
+    "PHASE2": "Phase 2",
+    "PHASE3": "Phase 3",
+    "PHASE4": "Phase 4",
+    "EARLY_PHASE1": "Early Phase 1"
+}
+
+def phase_label(design_module: Dict[str, Any]) -> str:
+    """Readable phase name for a study's design module"""
+    phases = design_module.get("phases", [])
+    study_type = design_module.get("studyType", "Unknown")
+    
+    if study_type == "OBSERVATIONAL":
+        return "Observational"
+    if phases and phases != ["NA"]:
+        # Most trials have one phase; use the first
+        return PHASE_LABELS.get(phases[0], "Other")
+    return "Not Applicable"
+
+def aggregate_studies(studies: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Compute all visualization aggregates in a single pass over the studies"""
     map_data = []
     phase_counts = Counter()
+    age_ranges = Counter()
+    gender_requirements = Counter()
+    study_types = Counter()
+    enrollment_sizes = []
+    # Trials grouped by eligibility (age range and sex) so profile filters never re-scan trials
+    eligibility_groups = {}
     
     for study in studies:
-        # Extract trial phase information from design module
         design_module = study.get("designModule", {})
-        phases = design_module.get("phases", [])
+        eligibility_module = study.get("eligibilityModule", {})
         study_type = design_module.get("studyType", "Unknown")
         
-        # Determine phase based on design module data
-        if study_type == "OBSERVATIONAL":
-            phase = "Observational"
-        elif phases and phases != ["NA"]:
-            # Get the first phase (most trials have one phase)
-            phase_code = phases[0] if phases else "NA"
-            
-            # Map phase codes to readable names
-            if phase_code == "PHASE1":
-                phase = "Phase 1"
-            elif phase_code == "PHASE2":
-                phase = "Phase 2"
-            elif phase_code == "PHASE3":
-                phase = "Phase 3"
-            elif phase_code == "PHASE4":
-                phase = "Phase 4"
-            elif phase_code == "EARLY_PHASE1":
-                phase = "Early Phase 1"
-            else:
-                phase = "Other"
-        else:
-            phase = "Not Applicable"
-            
+        # Phase distribution
+        phase = phase_label(design_module)
         phase_counts[phase] += 1
         
-        # Extract location information
-        locations_module = study.get("locationsModule", {})
-        locations = locations_module.get("locations", [])
-        
+        # Map data from location information with coordinates
+        brief_title = study.get("briefTitle", "")
+        locations = study.get("locationsModule", {}).get("locations", [])
         for location in locations:
-            facility = location.get("facility", "")
             city = location.get("city", "")
             country = location.get("country", "")
             
@@ -532,38 +2481,20 @@ def prepare_visualizations(state: AgentState) -> AgentState:
                 map_data.append({
                     "lat": coordinates["lat"],
                     "lon": coordinates["lon"],
-                    "facility": facility,
+                    "facility": location.get("facility", ""),
                     "city": city,
                     "country": country,
-                    "trial_title": study.get("briefTitle", "")[:80] + ("..." if len(study.get("briefTitle", "")) > 80 else ""),
+                    "trial_title": brief_title[:80] + ("..." if len(brief_title) > 80 else ""),
                     "nct_id": study.get("nctId", ""),
                     "phase": phase
                 })
-    
-    # Prepare demographic data
-    age_ranges = Counter()
-    gender_requirements = Counter()
-    study_types = Counter()
-    enrollment_sizes = []
-    
-    for study in studies:
-        # Extract eligibility information
-        eligibility_module = study.get("eligibilityModule", {})
-        design_module = study.get("designModule", {})
         
         # Age range analysis
-        min_age = eligibility_module.get("minimumAge", "Unknown")
-        max_age = eligibility_module.get("maximumAge", "Unknown")
-        std_ages = eligibility_module.get("stdAges", [])
-        
-        if std_ages:
-            for age_group in std_ages:
-                age_ranges[age_group] += 1
+        for age_group in eligibility_module.get("stdAges", []):
+            age_ranges[age_group] += 1
         
         # Gender requirements
         sex = eligibility_module.get("sex", "Unknown")
-        gender_based = eligibility_module.get("genderBased", False)
-        
         if sex == "ALL":
             gender_requirements["All Genders"] += 1
         elif sex == "MALE":
@@ -574,10 +2505,7 @@ def prepare_visualizations(state: AgentState) -> AgentState:
             gender_requirements["Not Specified"] += 1
         
         # Study type analysis
-        healthy_volunteers = eligibility_module.get("healthyVolunteers", False)
-        study_type = design_module.get("studyType", "Unknown")
-        
-        if healthy_volunteers:
+        if eligibility_module.get("healthyVolunteers", False):
             study_types["Healthy Volunteers"] += 1
         elif study_type == "INTERVENTIONAL":
             study_types["Interventional"] += 1
@@ -587,22 +2515,287 @@ def prepare_visualizations(state: AgentState) -> AgentState:
             study_types["Other"] += 1
         
         # Enrollment size
-        enrollment_info = design_module.get("enrollmentInfo", {})
-        enrollment_count = enrollment_info.get("count", 0)
+        enrollment_count = design_module.get("enrollmentInfo", {}).get("count", 0)
         if enrollment_count > 0:
             enrollment_sizes.append(enrollment_count)
+        
+        # Eligibility group for profile-filtered aggregates
+        min_age = parse_age(eligibility_module.get("minimumAge", 0))
+        max_age = parse_age(eligibility_module.get("maximumAge", 100))
+        group_sex = eligibility_module.get("sex", "ALL")
+        group_key = f"{min_age}|{max_age}|{group_sex}"
+        group = eligibility_groups.get(group_key)
+        if group is None:
+            group = {
+                "min_age": min_age,
+                "max_age": max_age,
+                "sex": group_sex,
+                "trials": 0,
+                "enrollment_total": 0,
+                "enrollment_count": 0,
+                "enrollment_max": 0,
+                "enrollment_min": 0
+            }
+            eligibility_groups[group_key] = group
+        group["trials"] += 1
+        if enrollment_count > 0:
+            group["enrollment_min"] = min(group["enrollment_min"], enrollment_count) if group["enrollment_count"] else enrollment_count
+            group["enrollment_max"] = max(group["enrollment_max"], enrollment_count)
+            group["enrollment_total"] += enrollment_count
+            group["enrollment_count"] += 1
+    
+    return {
+        "map_data": map_data,
+        "phase_data": dict(phase_counts),
+        "age_data": dict(age_ranges),
+        "gender_data": dict(gender_requirements),
+        "study_type_data": dict(study_types),
+        "enrollment_sizes": enrollment_sizes,
+        "eligibility_groups": list(eligibility_groups.values())
+    }
+
+def profile_aggregates(eligibility_groups: List[Dict[str, Any]], user_profile: Dict[str, Any]) -> Dict[str, Any]:
+    """Profile-filtered trial counts and enrollment stats, computed from eligibility groups"""
+    user_age = int(user_profile.get("age", 30))
+    user_gender = user_profile.get("gender", "All")
+    
+    matching_trials = 0
+    enrollment_total = 0
+    enrollment_count = 0
+    enrollment_max = 0
+    enrollment_min = 0
+    
+    for group in eligibility_groups:
+        age_match = group["min_age"] <= user_age <= group["max_age"]
+        gender_match = group["sex"] == "ALL" or group["sex"] == user_gender.upper()
+        if not (age_match and gender_match):
+            continue
+        
+        matching_trials += group["trials"]
+        if group["enrollment_count"]:
+            enrollment_min = min(enrollment_min, group["enrollment_min"]) if enrollment_count else group["enrollment_min"]
+            enrollment_max = max(enrollment_max, group["enrollment_max"])
+            enrollment_total += group["enrollment_total"]
+            enrollment_count += group["enrollment_count"]
+    
+    enrollment_stats = {}
+    if enrollment_count:
+        enrollment_stats = {
+            "Total Enrollment": enrollment_total,
+            "Average Enrollment": enrollment_total // enrollment_count,
+            "Largest Study": enrollment_max,
+            "Smallest Study": enrollment_min
+        }
+    
+    return {
+        "age": user_age,
+        "gender": user_gender,
+        "matching_trials": matching_trials,
+        "enrollment_stats": enrollment_stats
+    }
+
+def get_profile_aggregates(state: Dict[str, Any]) -> Dict[str, Any]:
+    """Stored profile aggregates, recomputed from eligibility groups if the profile changed since the search"""
+    user_profile = state.get("user_profile", {})
+    stored = state.get("profile_aggregates", {})
+    if stored and stored.get("age") == int(user_profile.get("age", 30)) and stored.get("gender") == user_profile.get("gender", "All"):
+        return stored
+    eligibility_groups = state.get("visualization_data", {}).get("eligibility_groups", [])
+    return profile_aggregates(eligibility_groups, user_profile)
+
+def prepare_visualizations(state: AgentState) -> AgentState:
+    """Prepare data for visualizations"""
+    api_results = state.get("api_results", {})
+    studies = api_results.get("studies", [])
+    
+    if not studies:
+        state["visualization_data"] = {}
+        state["profile_aggregates"] = {}
+        return state
     
-    state["visualization_data"] = {
-        "map_data": map_data,
-        "phase_data": dict(phase_counts),
-        "age_data": dict(age_ranges),
-        "gender_data": dict(gender_requirements),
-        "study_type_data": dict(study_types),
-        "enrollment_sizes": enrollment_sizes
-    }
+    # Global aggregates are profile-independent, so identical result sets share them (and their charts)
+    state["visualization_data"] = aggregate_studies(studies)
+    state["profile_aggregates"] = profile_aggregates(
+        state["visualization_data"]["eligibility_groups"],
+        state.get("user_profile", {})
+    )
     
     return state
 
+# Number of personalized recommendations kept per search
+TOP_K_RECOMMENDATIONS = 10
+
+class TopKRanker:
+    """Streaming top-K selection over scored trials using a bounded min-heap"""
+
+    def __init__(self, k: int = TOP_K_RECOMMENDATIONS):
+        self.k = k
+        self._heap = []
+        self._seen = 0
+
+    def add(self, trial: Dict[str, Any], score: int, match_reasons: List[str]):
+        """Offer one scored trial; memory stays O(K) however many trials are added"""
+        # Earlier trials win ties, and the unique sequence keeps dicts out of comparisons
+        entry = (score, -self._seen, trial, match_reasons)
+        self._seen += 1
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif entry[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, entry)
+
+    def results(self) -> List[Dict[str, Any]]:
+        """Best trials first"""
+        ranked = sorted(self._heap, key=lambda entry: entry[:2], reverse=True)
+        return [
+            {"trial": trial, "score": score, "match_reasons": match_reasons}
+            for score, _, trial, match_reasons in ranked
+        ]
+
+def trial_features(study: Dict[str, Any]) -> Dict[str, Any]:
+    """Extract the fields scoring rules look at, once per trial"""
+    eligibility = study.get("eligibilityModule", {})
+    design = study.get("designModule", {})
+    locations = study.get("locationsModule", {}).get("locations", [])
+    phases = design.get("phases", [])
+    
+    return {
+        # Parse age values to ensure proper comparison
+        "min_age": parse_age(eligibility.get("minimumAge", 0)),
+        "max_age": parse_age(eligibility.get("maximumAge", 100)),
+        "std_ages": eligibility.get("stdAges", []),
+        "sex": eligibility.get("sex", "ALL"),
+        "cities": [location.get("city", "").lower() for location in locations],
+        "countries": [location.get("country", "").lower() for location in locations],
+        "phase": phases[0] if phases and phases != ["NA"] else "",
+        "study_type": design.get("studyType", "")
+    }
+
+def age_in_range(features, profile, params):
+    return features["min_age"] <= profile.get("age", 30) <= features["max_age"]
+
+def age_group_match(features, profile, params):
+    user_age = profile.get("age", 30)
+    return age_in_range(features, profile, params) and any(
+        (age_group == "ADULT" and 18 <= user_age <= 65) or
+        (age_group == "OLDER_ADULT" and user_age > 65) or
+        (age_group == "CHILD" and user_age < 18)
+        for age_group in features["std_ages"]
+    )
+
+def sex_match(features, profile, params):
+    return features["sex"] == "ALL" or features["sex"] == profile.get("gender", "All").upper()
+
+def location_match(features, profile, params):
+    user_location = profile.get("location", "").lower()
+    return bool(user_location) and any(
+        user_location in city or user_location in country
+        for city, country in zip(features["cities"], features["countries"])
+    )
+
+def has_phase(features, profile, params):
+    return bool(features["phase"])
+
+def phase_matches_risk(features, profile, params):
+    return features["phase"] in params.get(profile.get("risk_tolerance", "moderate"), [])
+
+def study_type_matches_risk(features, profile, params):
+    return features["study_type"] in params.get(profile.get("risk_tolerance", "moderate"), [])
+
+# Conditions scoring rules can refer to by name
+SCORING_PREDICATES = {
+    "age_in_range": age_in_range,
+    "age_group_match": age_group_match,
+    "sex_match": sex_match,
+    "location_match": location_match,
+    "has_phase": has_phase,
+    "phase_matches_risk": phase_matches_risk,
+    "study_type_matches_risk": study_type_matches_risk
+}
+
+# Default scoring model; operators can override it with a JSON file via SCORING_MODEL_PATH
+DEFAULT_SCORING_MODEL = {
+    "high_score_threshold": 70,
+    "rules": [
+        {"name": "age", "predicate": "age_in_range", "weight": 20,
+         "reason": "Age {user_age} fits eligibility range ({min_age}-{max_age})"},
+        {"name": "age_group", "predicate": "age_group_match", "weight": 10},
+        {"name": "gender", "predicate": "sex_match", "weight": 15, "reason": "Gender requirement: {sex}"},
+        {"name": "location", "predicate": "location_match", "weight": 25},
+        {"name": "phase", "predicate": "has_phase", "weight": 0, "reason": "Phase: {phase}"},
+        {"name": "phase_risk", "predicate": "phase_matches_risk", "weight": 15,
+         "params": {"low": ["PHASE3", "PHASE4"], "moderate": ["PHASE2"], "high": ["PHASE1", "EARLY_PHASE1"]}},
+        {"name": "study_type_risk", "predicate": "study_type_matches_risk", "weight": 10,
+         "params": {"low": ["OBSERVATIONAL"], "moderate": ["INTERVENTIONAL"], "high": ["INTERVENTIONAL"]}}
+    ]
+}
+
+class ScoringModel:
+    """Weighted rule list compiled once into a fast trial evaluator"""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.high_score_threshold = config.get("high_score_threshold", 70)
+        self.rules = []
+        for rule in config["rules"]:
+            predicate = SCORING_PREDICATES.get(rule["predicate"])
+            if predicate is None:
+                raise ValueError(f"Unknown scoring predicate '{rule['predicate']}' in rule '{rule.get('name')}'")
+            self.rules.append((predicate, rule.get("params", {}), rule.get("weight", 0), rule.get("reason")))
+
+    def score_features(self, features: Dict[str, Any], user_profile: Dict[str, Any]):
+        """Score precomputed trial features, returning the score and match reasons"""
+        score = 0
+        reasons = []
+        for predicate, params, weight, reason in self.rules:
+            if predicate(features, user_profile, params):
+                score += weight
+                if reason:
+                    reasons.append(reason.format(user_age=user_profile.get("age", 30), **features))
+        return score, reasons
+
+    def score(self, study: Dict[str, Any], user_profile: Dict[str, Any]):
+        """Score one trial against the user profile"""
+        return self.score_features(trial_features(study), user_profile)
+
+    def score_batch(self, studies: List[Dict[str, Any]], user_profile: Dict[str, Any]) -> List[int]:
+        """Score many trials rule by rule; used by the results browser and for benchmarking weightings"""
+        features = [trial_features(study) for study in studies]
+        scores = [0] * len(features)
+        for predicate, params, weight, _ in self.rules:
+            if not weight:
+                continue
+            for i, trial in enumerate(features):
+                if predicate(trial, user_profile, params):
+                    scores[i] += weight
+        return scores
+
+@st.cache_resource(show_spinner=False)
+def get_scoring_model():
+    """Load the scoring model from SCORING_MODEL_PATH, falling back to the default weights"""
+    config_path = os.getenv("SCORING_MODEL_PATH")
+    if config_path:
+        try:
+            with open(config_path) as config_file:
+                return ScoringModel(json.load(config_file))
+        except Exception as e:
+            st.error(f"Error loading scoring model from {config_path}: {str(e)}")
+    return ScoringModel(DEFAULT_SCORING_MODEL)
+
+def score_trial(study: Dict[str, Any], user_profile: Dict[str, Any]):
+    """Score one trial against the user profile, recording match reasons in the same pass"""
+    return get_scoring_model().score(study, user_profile)
+
+def rank_trials(studies, user_profile: Dict[str, Any], k: int = TOP_K_RECOMMENDATIONS) -> List[Dict[str, Any]]:
+    """Score trials incrementally (any iterable, e.g. pages as they arrive) and keep the top K"""
+    ranker = TopKRanker(k)
+    scoring_model = get_scoring_model()
+    for study in studies:
+        # Skip trials whose structured criteria rule the user out
+        if criteria_conflicts(study.get("parsedCriteria", {}), user_profile):
+            continue
+        score, match_reasons = scoring_model.score(study, user_profile)
+        ranker.add(study, score, match_reasons)
+    return ranker.results()
+
 def patient_profile_matcher(state: AgentState) -> AgentState:
     """Analyze user profile and match with most relevant trials"""
     api_results = state.get("api_results", {})
@@ -613,208 +2806,123 @@ def patient_profile_matcher(state: AgentState) -> AgentState:
         state["personalized_recommendations"] = []
         return state
     
-    # Extract user profile information
-    user_age = user_profile.get("age", 30)
-    user_gender = user_profile.get("gender", "All")
-    user_location = user_profile.get("location", "")
-    user_travel_preference = user_profile.get("travel_preference", "local")
-    user_risk_tolerance = user_profile.get("risk_tolerance", "moderate")
+    # Lab values and pregnancy can only be checked against criteria text, so every trial's criteria are loaded
+    if profile_needs_criteria(user_profile):
+        studies = load_criteria(state)
     
-    # Score each trial based on user profile
-    scored_trials = []
+    recommendations = rank_trials(studies, user_profile)
     
-    for study in studies:
-        score = 0
-        eligibility = study.get("eligibilityModule", {})
-        design = study.get("designModule", {})
-        locations = study.get("locationsModule", {})
-        
-        # Age matching (higher score for exact matches)
-        min_age = eligibility.get("minimumAge", 0)
-        max_age = eligibility.get("maximumAge", 100)
-        std_ages = eligibility.get("stdAges", [])
-        
-        # Parse age values to ensure proper comparison
-        min_age = parse_age(min_age)
-        max_age = parse_age(max_age)
-        
-        if min_age <= user_age <= max_age:
-            score += 20
-            if std_ages:
-                for age_group in std_ages:
-                    if (age_group == "ADULT" and 18 <= user_age <= 65) or \
-                       (age_group == "OLDER_ADULT" and user_age > 65) or \
-                       (age_group == "CHILD" and user_age < 18):
-                        score += 10
-        
-        # Gender matching
-        sex = eligibility.get("sex", "ALL")
-        if sex == "ALL" or sex == user_gender.upper():
-            score += 15
-        
-        # Location matching (simplified)
-        if user_location and locations.get("locations"):
-            for location in locations["locations"]:
-                if user_location.lower() in location.get("city", "").lower() or \
-                   user_location.lower() in location.get("country", "").lower():
-                    score += 25
-                    break
-        
-        # Phase preference based on risk tolerance
-        phases = design.get("phases", [])
-        if phases and phases != ["NA"]:
-            phase = phases[0] if phases else "NA"
-            if user_risk_tolerance == "low" and phase in ["PHASE3", "PHASE4"]:
-                score += 15  # Prefer later phases (safer)
-            elif user_risk_tolerance == "high" and phase in ["PHASE1", "EARLY_PHASE1"]:
-                score += 15  # Prefer early phases (more experimental)
-            elif user_risk_tolerance == "moderate" and phase in ["PHASE2"]:
-                score += 15  # Prefer middle phases
-        
-        # Study type preference
-        study_type = design.get("studyType", "")
-        if study_type == "INTERVENTIONAL" and user_risk_tolerance != "low":
-            score += 10
-        elif study_type == "OBSERVATIONAL" and user_risk_tolerance == "low":
-            score += 10
-        
-        # Add trial with score
-        scored_trials.append({
-            "trial": study,
-            "score": score,
-            "match_reasons": []
-        })
+    state["personalized_recommendations"] = recommendations
+    state["messages"].append(AIMessage(content=f"Generated personalized recommendations for {len(recommendations)} trials based on your profile."))
     
-    # Sort by score and add match reasons
-    scored_trials.sort(key=lambda x: x["score"], reverse=True)
+    return state
+
+# Risk classification: cheap rule-based pass over every trial, cached per trial version
+def classify_risk(study: Dict[str, Any]) -> Dict[str, Any]:
+    """Rule-based risk level, risk factors and benefits of a trial"""
+    design = study.get("designModule", {})
+    # Criteria counts are only known for trials whose criteria were loaded
+    parsed_criteria = study.get("parsedCriteria") if criteria_loaded(study) else None
     
-    # Generate match reasons for top trials
-    for trial_info in scored_trials[:10]:  # Top 10 trials
-        trial = trial_info["trial"]
-        reasons = []
-        
-        eligibility = trial.get("eligibilityModule", {})
-        design = trial.get("designModule", {})
-        
-        # Age reason
-        min_age = eligibility.get("minimumAge", 0)
-        max_age = eligibility.get("maximumAge", 100)
-        
-        # Parse age values to ensure proper comparison
-        min_age = parse_age(min_age)
-        max_age = parse_age(max_age)
-        
-        if min_age <= user_age <= max_age:
-            reasons.append(f"Age {user_age} fits eligibility range ({min_age}-{max_age})")
+    # Extract key risk factors
+    phases = design.get("phases", [])
+    study_type = design.get("studyType", "")
+    intervention_model = design.get("interventionModel", "")
+    
+    # Determine risk level based on phase and design
+    risk_level = "Low"
+    risk_factors = []
+    benefits = []
+    
+    if phases and phases != ["NA"]:
+        phase = phases[0] if phases else "NA"
+        if phase in ["PHASE1", "EARLY_PHASE1"]:
+            risk_level = "High"
+            risk_factors.append("Early phase trial - limited safety data available")
+            benefits.append("Access to cutting-edge experimental treatments")
+        elif phase == "PHASE2":
+            risk_level = "Medium-High"
+            risk_factors.append("Phase 2 trial - safety established, effectiveness being tested")
+            benefits.append("Treatment has passed initial safety testing")
+        elif phase == "PHASE3":
+            risk_level = "Medium"
+            risk_factors.append("Phase 3 trial - comparing with standard treatments")
+            benefits.append("Treatment has shown promise in earlier phases")
+        elif phase == "PHASE4":
+            risk_level = "Low"
+            risk_factors.append("Phase 4 trial - post-approval safety monitoring")
+            benefits.append("Treatment is already FDA-approved")
+    
+    # Study type risks
+    if study_type == "INTERVENTIONAL":
+        risk_factors.append("Interventional study - involves active treatment")
+        benefits.append("May receive the actual treatment being studied")
+    elif study_type == "OBSERVATIONAL":
+        risk_factors.append("Observational study - no active treatment")
+        benefits.append("Lower risk - just monitoring and observation")
+    
+    # Intervention model risks
+    if intervention_model == "SINGLE_GROUP":
+        risk_factors.append("Single group study - no comparison group")
+        benefits.append("All participants receive the treatment")
+    elif intervention_model == "PARALLEL":
+        risk_factors.append("Randomized study - may receive placebo or standard treatment")
+        benefits.append("May receive the experimental treatment")
+    
+    return {
+        "title": study.get("briefTitle", ""),
+        "risk_level": risk_level,
+        "risk_factors": risk_factors,
+        "benefits": benefits,
+        "phase": phases[0] if phases and phases != ["NA"] else "Unknown",
+        "study_type": study_type,
+        "inclusion_count": len(parsed_criteria["inclusion"]) if parsed_criteria else None,
+        "exclusion_count": len(parsed_criteria["exclusion"]) if parsed_criteria else None
+    }
+
+def render_risk_summary(assessment: Dict[str, Any]) -> str:
+    """Markdown risk summary for a displayed trial"""
+    phase = assessment["phase"] if assessment["phase"] != "Unknown" else "Not specified"
+    return f"""
+        **Risk Level: {assessment['risk_level']}**
         
-        # Gender reason
-        sex = eligibility.get("sex", "ALL")
-        if sex == "ALL" or sex == user_gender.upper():
-            reasons.append(f"Gender requirement: {sex}")
+        **Risk Factors:**
+        {chr(10).join([f"• {factor}" for factor in assessment['risk_factors']])}
         
-        # Phase reason
-        phases = design.get("phases", [])
-        if phases and phases != ["NA"]:
-            phase = phases[0] if phases else "NA"
-            reasons.append(f"Phase: {phase}")
+        **Potential Benefits:**
+        {chr(10).join([f"• {benefit}" for benefit in assessment['benefits']])}
         
-        trial_info["match_reasons"] = reasons
-    
-    state["personalized_recommendations"] = scored_trials[:10]
-    state["messages"].append(AIMessage(content=f"Generated personalized recommendations for {len(scored_trials[:10])} trials based on your profile."))
-    
-    return state
+        **Safety Considerations:**
+        • This is a {assessment['study_type'].lower()} study
+        • Phase: {phase}
+        """ + ("" if assessment["inclusion_count"] is None else f"""• {assessment['inclusion_count']} inclusion criteria
+        • {assessment['exclusion_count']} exclusion criteria
+        """)
+
+@st.cache_resource(show_spinner=False)
+def get_risk_cache():
+    """Process-wide cache of risk assessments keyed by nctId and last update date"""
+    return ResponseCache(max_entries=20000, ttl_seconds=float(os.getenv("RISK_CACHE_TTL_SECONDS", "86400")))
 
 def risk_analyzer(state: AgentState) -> AgentState:
     """Analyze and explain risks and benefits of trials"""
     api_results = state.get("api_results", {})
     studies = api_results.get("studies", [])
-    selected_model = state.get("selected_model", "gpt-3.5-turbo")
     
     if not studies:
         state["risk_assessments"] = {}
         return state
     
+    # Classify every trial; a trial is only re-classified when it has been updated
+    risk_cache = get_risk_cache()
     risk_assessments = {}
-    
-    for study in studies[:5]:  # Analyze top 5 trials
-        nct_id = study.get("nctId", "")
-        brief_title = study.get("briefTitle", "")
-        design = study.get("designModule", {})
-        eligibility = study.get("eligibilityModule", {})
-        
-        # Extract key risk factors
-        phases = design.get("phases", [])
-        study_type = design.get("studyType", "")
-        intervention_model = design.get("interventionModel", "")
-        allocation = design.get("allocation", "")
-        
-        # Determine risk level based on phase and design
-        risk_level = "Low"
-        risk_factors = []
-        benefits = []
-        
-        if phases and phases != ["NA"]:
-            phase = phases[0] if phases else "NA"
-            if phase in ["PHASE1", "EARLY_PHASE1"]:
-                risk_level = "High"
-                risk_factors.append("Early phase trial - limited safety data available")
-                benefits.append("Access to cutting-edge experimental treatments")
-            elif phase == "PHASE2":
-                risk_level = "Medium-High"
-                risk_factors.append("Phase 2 trial - safety established, effectiveness being tested")
-                benefits.append("Treatment has passed initial safety testing")
-            elif phase == "PHASE3":
-                risk_level = "Medium"
-                risk_factors.append("Phase 3 trial - comparing with standard treatments")
-                benefits.append("Treatment has shown promise in earlier phases")
-            elif phase == "PHASE4":
-                risk_level = "Low"
-                risk_factors.append("Phase 4 trial - post-approval safety monitoring")
-                benefits.append("Treatment is already FDA-approved")
-        
-        # Study type risks
-        if study_type == "INTERVENTIONAL":
-            risk_factors.append("Interventional study - involves active treatment")
-            benefits.append("May receive the actual treatment being studied")
-        elif study_type == "OBSERVATIONAL":
-            risk_factors.append("Observational study - no active treatment")
-            benefits.append("Lower risk - just monitoring and observation")
-        
-        # Intervention model risks
-        if intervention_model == "SINGLE_GROUP":
-            risk_factors.append("Single group study - no comparison group")
-            benefits.append("All participants receive the treatment")
-        elif intervention_model == "PARALLEL":
-            risk_factors.append("Randomized study - may receive placebo or standard treatment")
-            benefits.append("May receive the experimental treatment")
-        
-        # Create risk assessment summary
-        risk_summary = f"""
-        **Risk Level: {risk_level}**
-        
-        **Risk Factors:**
-        {chr(10).join([f"• {factor}" for factor in risk_factors])}
-        
-        **Potential Benefits:**
-        {chr(10).join([f"• {benefit}" for benefit in benefits])}
-        
-        **Safety Considerations:**
-        • This is a {study_type.lower()} study
-        • Phase: {phases[0] if phases and phases != ['NA'] else 'Not specified'}
-        • {len(eligibility.get('inclusionCriteria', '').split()) if eligibility.get('inclusionCriteria') else 0} inclusion criteria
-        • {len(eligibility.get('exclusionCriteria', '').split()) if eligibility.get('exclusionCriteria') else 0} exclusion criteria
-        """
-        
-        risk_assessments[nct_id] = {
-            "title": brief_title,
-            "risk_level": risk_level,
-            "risk_factors": risk_factors,
-            "benefits": benefits,
-            "summary": risk_summary,
-            "phase": phases[0] if phases and phases != ["NA"] else "Unknown",
-            "study_type": study_type
-        }
+    for study in studies:
+        cache_key = ("risk", study.get("nctId", ""), study.get("lastUpdatePostDate", ""), criteria_loaded(study))
+        assessment = risk_cache.get(cache_key)
+        if assessment is None:
+            assessment = classify_risk(study)
+            risk_cache.set(cache_key, assessment)
+        risk_assessments[study.get("nctId", "")] = assessment
     
     state["risk_assessments"] = risk_assessments
     state["messages"].append(AIMessage(content=f"Completed risk analysis for {len(risk_assessments)} trials."))
@@ -828,6 +2936,7 @@ def quality_evaluator(state: AgentState) -> AgentState:
     personalized_recommendations = state.get("personalized_recommendations", [])
     risk_assessments = state.get("risk_assessments", {})
     user_profile = state.get("user_profile", {})
+    high_score_threshold = get_scoring_model().high_score_threshold
     
     # Quality metrics
     quality_score = 0
@@ -842,7 +2951,7 @@ def quality_evaluator(state: AgentState) -> AgentState:
     
     # Check if personalized recommendations are good
     if personalized_recommendations:
-        high_score_trials = [r for r in personalized_recommendations if r.get("score", 0) > 70]
+        high_score_trials = [r for r in personalized_recommendations if r.get("score", 0) > high_score_threshold]
         if len(high_score_trials) < 3:
             quality_score -= 15
             refinement_needed = True
@@ -880,32 +2989,37 @@ def quality_evaluator(state: AgentState) -> AgentState:
         "refinement_needed": refinement_needed,
         "refinement_type": refinement_type,
         "total_trials": len(studies),
-        "high_score_trials": len([r for r in personalized_recommendations if r.get("score", 0) > 70]) if personalized_recommendations else 0,
+        "high_score_trials": len([r for r in personalized_recommendations if r.get("score", 0) > high_score_threshold]) if personalized_recommendations else 0,
         "location_coverage": location_matches if user_location else "N/A"
     }
     
     return state
 
+# Expand disease search terms
+DISEASE_EXPANSIONS = {
+    "cancer": ["cancer", "tumor", "malignancy", "neoplasm"],
+    "diabetes": ["diabetes", "diabetic", "glucose", "insulin"],
+    "heart": ["heart", "cardiac", "cardiovascular", "coronary"],
+    "lung": ["lung", "pulmonary", "respiratory", "bronchial"],
+    "breast": ["breast", "mammary", "ductal", "lobular"],
+    "prostate": ["prostate", "prostatic", "glandular"],
+    "brain": ["brain", "cerebral", "neurological", "cognitive"]
+}
+
 def search_refiner(state: AgentState) -> AgentState:
     """Refine the search criteria to get better results"""
+    remaining = remaining_budget(state)
+    if remaining is not None and remaining < MIN_REFINEMENT_SECONDS:
+        state.setdefault("degraded", []).append("search_refiner: skipped (deadline reached)")
+        return state
+    
     current_disease = state.get("disease_name", "")
     api_results = state.get("api_results", {})
     quality_metrics = state.get("quality_metrics", {})
     
-    # Expand disease search terms
-    disease_expansions = {
-        "cancer": ["cancer", "tumor", "malignancy", "neoplasm"],
-        "diabetes": ["diabetes", "diabetic", "glucose", "insulin"],
-        "heart": ["heart", "cardiac", "cardiovascular", "coronary"],
-        "lung": ["lung", "pulmonary", "respiratory", "bronchial"],
-        "breast": ["breast", "mammary", "ductal", "lobular"],
-        "prostate": ["prostate", "prostatic", "glandular"],
-        "brain": ["brain", "cerebral", "neurological", "cognitive"]
-    }
-    
     # Find expansion for current disease
     expanded_terms = []
-    for key, terms in disease_expansions.items():
+    for key, terms in DISEASE_EXPANSIONS.items():
         if key.lower() in current_disease.lower():
             expanded_terms = terms
             break
@@ -929,6 +3043,11 @@ def search_refiner(state: AgentState) -> AgentState:
 
 def profile_refiner(state: AgentState) -> AgentState:
     """Refine user profile to get better trial matches"""
+    remaining = remaining_budget(state)
+    if remaining is not None and remaining < MIN_REFINEMENT_SECONDS:
+        state.setdefault("degraded", []).append("profile_refiner: skipped (deadline reached)")
+        return state
+    
     user_profile = state.get("user_profile", {})
     quality_metrics = state.get("quality_metrics", {})
     personalized_recommendations = state.get("personalized_recommendations", [])
@@ -946,7 +3065,8 @@ def profile_refiner(state: AgentState) -> AgentState:
     # Check location flexibility
     user_location = user_profile.get("location", "")
     travel_preference = user_profile.get("travel_preference", "local")
-    if travel_preference == "local" and quality_metrics.get("location_coverage", 0) < 5:
+    # Coverage is "N/A" when no location is set
+    if travel_preference == "local" and user_location and quality_metrics.get("location_coverage", 0) < 5:
         profile_issues.append("Local trials may be limited")
         suggested_improvements["travel_flexibility"] = "Consider expanding travel radius"
     
@@ -979,15 +3099,26 @@ def route_based_on_quality(state: AgentState) -> str:
     
     return "proceed"
 
+# Async variants of the I/O-bound nodes; the CPU-bound nodes are shared
+ASYNC_NODES = {
+    "clarify_disease": async_clarify_disease,
+    "search_clinical_trials": async_search_clinical_trials,
+    "summarize_eligibility": async_summarize_eligibility
+}
+
 # Create LangGraph
-def create_agent_graph():
-    """Create the LangGraph workflow"""
+def create_agent_graph(use_async: bool = False, checkpointer=None):
+    """Create the LangGraph workflow, with async I/O nodes for ainvoke when use_async is set"""
     workflow = StateGraph(AgentState)
     
     # Add nodes
-    workflow.add_node("clarify_disease", clarify_disease)
-    workflow.add_node("search_clinical_trials", search_clinical_trials)
-    workflow.add_node("summarize_eligibility", summarize_eligibility)
+    if use_async:
+        for name, node in ASYNC_NODES.items():
+            workflow.add_node(name, node)
+    else:
+        workflow.add_node("clarify_disease", clarify_disease)
+        workflow.add_node("search_clinical_trials", search_clinical_trials)
+        workflow.add_node("summarize_eligibility", summarize_eligibility)
     workflow.add_node("prepare_visualizations", prepare_visualizations)
     workflow.add_node("patient_profile_matcher", patient_profile_matcher)
     workflow.add_node("risk_analyzer", risk_analyzer)
@@ -1007,12 +3138,252 @@ def create_agent_graph():
     workflow.add_edge("search_refiner", "profile_refiner")
     workflow.add_edge("profile_refiner", END)
     
-    return workflow.compile()
+    # With a checkpointer every completed node is saved under the run's thread_id
+    return workflow.compile(checkpointer=checkpointer)
+
+# Run the graph through its async interface unless ASYNC_GRAPH is disabled
+USE_ASYNC_GRAPH = os.getenv("ASYNC_GRAPH", "true").lower() in ("1", "true", "yes")
 
 # Initialize the agent
 @st.cache_resource
-def get_agent():
-    return create_agent_graph()
+def get_agent(use_async: bool = False):
+    return create_agent_graph(use_async)
+
+# SQLite file holding per-node graph checkpoints for each browser session
+CHECKPOINTS_PATH = os.getenv("CHECKPOINTS_PATH", ".trial_navigator/checkpoints.db")
+# Sessions not run for this long are deleted from the checkpoint database (default one week)
+CHECKPOINT_TTL_SECONDS = float(os.getenv("CHECKPOINT_TTL_SECONDS", "604800"))
+# Minimum seconds between two prune passes
+CHECKPOINT_PRUNE_INTERVAL_SECONDS = 3600
+# JSON-like state values at least this large are stored once by reference instead of inside every checkpoint
+CHECKPOINT_PAYLOAD_MIN_BYTES = 4096
+
+# Checkpoint payloads: heavy state values shared by all checkpoints that reference them
+class CheckpointPayloadStore:
+    """SQLite-backed payloads referenced from checkpoints, read through the result store, and thread last-use times"""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._last_prune = 0
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint_payloads ("
+                "ref TEXT PRIMARY KEY, payload TEXT NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoint_threads (thread_id TEXT PRIMARY KEY, used_at REAL NOT NULL)"
+            )
+
+    def put(self, payload, serialized: str) -> str:
+        """Store a payload (or refresh its last use) and return its result-store reference"""
+        ref = get_result_store().put(payload)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO checkpoint_payloads (ref, payload, used_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(ref) DO UPDATE SET used_at = excluded.used_at",
+                (ref, serialized, time.time())
+            )
+        return ref
+
+    def get(self, ref: str):
+        """Return the payload for a reference, or None once it was pruned"""
+        store = get_result_store()
+        payload = store.get(ref)
+        if payload is None:
+            with self._lock:
+                row = self._conn.execute("SELECT payload FROM checkpoint_payloads WHERE ref = ?", (ref,)).fetchone()
+            if row is None:
+                return None
+            payload = json.loads(row[0])
+            store.put(payload)
+        return payload
+
+    def touch_thread(self, thread_id: str):
+        """Record that a thread was just run"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoint_threads (thread_id, used_at) VALUES (?, ?)", (thread_id, time.time())
+            )
+
+    def expire(self, ttl_seconds: float) -> List[str]:
+        """Forget threads and payloads unused for ttl_seconds; returns the expired thread ids, at most once per interval
+
+        Payloads are refreshed every time a checkpoint references them, so a live thread's payloads never expire.
+        """
+        now = time.time()
+        if now - self._last_prune < CHECKPOINT_PRUNE_INTERVAL_SECONDS:
+            return []
+        self._last_prune = now
+        cutoff = now - ttl_seconds
+        with self._lock, self._conn:
+            try:
+                # Threads checkpointed before they were tracked start their TTL now
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO checkpoint_threads (thread_id, used_at) SELECT DISTINCT thread_id, ? FROM checkpoints",
+                    (now,)
+                )
+            except sqlite3.OperationalError:
+                pass
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT thread_id FROM checkpoint_threads WHERE used_at < ?", (cutoff,)
+            )]
+            self._conn.execute("DELETE FROM checkpoint_threads WHERE used_at < ?", (cutoff,))
+            self._conn.execute("DELETE FROM checkpoint_payloads WHERE used_at < ?", (cutoff,))
+        return expired
+
+@st.cache_resource(show_spinner=False)
+def get_checkpoint_payloads():
+    """Process-wide checkpoint payload store"""
+    return CheckpointPayloadStore(CHECKPOINTS_PATH)
+
+class CheckpointSerializer:
+    """Checkpoint serializer that stores large JSON-like state values by result-store reference"""
+
+    def __init__(self, payloads: CheckpointPayloadStore):
+        self.payloads = payloads
+        self.serde = JsonPlusSerializer()
+
+    def _dehydrate(self, value):
+        if not value or not isinstance(value, (dict, list)) or (isinstance(value, dict) and RESULT_REF_KEY in value):
+            return value
+        try:
+            serialized = json.dumps(value)
+        except (TypeError, ValueError):
+            # Messages and other typed values stay inline
+            return value
+        if len(serialized) < CHECKPOINT_PAYLOAD_MIN_BYTES:
+            return value
+        return {RESULT_REF_KEY: self.payloads.put(value, serialized)}
+
+    def _hydrate(self, value):
+        if isinstance(value, dict) and RESULT_REF_KEY in value:
+            payload = self.payloads.get(value[RESULT_REF_KEY])
+            # A pruned payload stays a reference, which hydrate_state treats as an empty result
+            return value if payload is None else payload
+        return value
+
+    def dumps_typed(self, obj):
+        # Whole checkpoints carry every channel; pending writes carry one channel value each
+        if isinstance(obj, dict) and isinstance(obj.get("channel_values"), dict):
+            obj = dict(obj, channel_values={key: self._dehydrate(value) for key, value in obj["channel_values"].items()})
+        else:
+            obj = self._dehydrate(obj)
+        return self.serde.dumps_typed(obj)
+
+    def loads_typed(self, data):
+        obj = self.serde.loads_typed(data)
+        if isinstance(obj, dict) and isinstance(obj.get("channel_values"), dict):
+            obj["channel_values"] = {key: self._hydrate(value) for key, value in obj["channel_values"].items()}
+            return obj
+        return self._hydrate(obj)
+
+@st.cache_resource
+def get_checkpointed_agent():
+    """Sync graph checkpointed to SQLite, or None when checkpointing is unavailable"""
+    if SqliteSaver is None:
+        return None
+    directory = os.path.dirname(CHECKPOINTS_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    checkpointer = SqliteSaver(sqlite3.connect(CHECKPOINTS_PATH, check_same_thread=False), serde=CheckpointSerializer(get_checkpoint_payloads()))
+    checkpointer.setup()
+    return create_agent_graph(checkpointer=checkpointer)
+
+def prune_checkpoints():
+    """Delete the checkpoints of sessions not run within CHECKPOINT_TTL_SECONDS"""
+    agent = get_checkpointed_agent()
+    if agent is None:
+        return
+    for thread_id in get_checkpoint_payloads().expire(CHECKPOINT_TTL_SECONDS):
+        agent.checkpointer.delete_thread(thread_id)
+
+async def arun_checkpointed_agent(state: Dict[str, Any], config: Dict[str, Any]) -> Dict[str, Any]:
+    """Run the async graph with an async SQLite checkpointer bound to the current event loop"""
+    async with aiosqlite.connect(CHECKPOINTS_PATH) as conn:
+        checkpointer = AsyncSqliteSaver(conn, serde=CheckpointSerializer(get_checkpoint_payloads()))
+        await checkpointer.setup()
+        # A new search replaces the thread's checkpoints; resuming (state None) keeps them
+        if state is not None and hasattr(checkpointer, "adelete_thread"):
+            await checkpointer.adelete_thread(config["configurable"]["thread_id"])
+        agent = create_agent_graph(use_async=True, checkpointer=checkpointer)
+        return await agent.ainvoke(state, config)
+
+def run_agent(state: Dict[str, Any], thread_id: str = None) -> Dict[str, Any]:
+    """Run the graph on a state, through ainvoke when the async graph is enabled
+
+    With a thread_id each completed node is checkpointed; a None state resumes the thread's last run.
+    """
+    # Upstream rate limits are shared fairly between sessions
+    current_session_id.set(thread_id or "anonymous")
+    checkpointed_agent = get_checkpointed_agent() if thread_id else None
+    if checkpointed_agent is not None:
+        config = {"configurable": {"thread_id": thread_id}}
+        get_checkpoint_payloads().touch_thread(thread_id)
+        prune_checkpoints()
+        if USE_ASYNC_GRAPH:
+            return asyncio.run(arun_checkpointed_agent(state, config))
+        if state is not None and hasattr(checkpointed_agent.checkpointer, "delete_thread"):
+            checkpointed_agent.checkpointer.delete_thread(thread_id)
+        return checkpointed_agent.invoke(state, config)
+    
+    if USE_ASYNC_GRAPH:
+        return asyncio.run(get_agent(use_async=True).ainvoke(state))
+    return get_agent().invoke(state)
+
+# Streamlit's per-browser XSRF cookie, used to bind session ids to the browser
+BROWSER_COOKIE = "_streamlit_xsrf"
+
+@st.cache_resource
+def get_session_secret() -> bytes:
+    """Key for deriving session ids: SESSION_SECRET, or a random key kept next to the checkpoints"""
+    if os.getenv("SESSION_SECRET"):
+        return os.getenv("SESSION_SECRET").encode("utf-8")
+    path = os.path.join(os.path.dirname(CHECKPOINTS_PATH) or ".", "session_secret")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        # Readable by the server user only
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, "rb") as secret_file:
+            return secret_file.read()
+    secret = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as secret_file:
+        secret_file.write(secret)
+    return secret
+
+def get_session_id() -> str:
+    """Checkpoint thread id for this browser session
+
+    The URL only keeps a random key so reloads and restarts find the session; the thread id is derived from it
+    with a server secret and the browser's cookie, so a copied link opens an empty session in another browser.
+    """
+    session_key = st.query_params.get("session")
+    if not session_key:
+        session_key = uuid.uuid4().hex
+        st.query_params["session"] = session_key
+    # st.context is only available on newer Streamlit versions; without the cookie the id is still unguessable
+    cookies = getattr(getattr(st, "context", None), "cookies", None) or {}
+    browser_key = cookies.get(BROWSER_COOKIE, "")
+    return hmac.new(get_session_secret(), f"{session_key}|{browser_key}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+def restore_session(thread_id: str):
+    """Final state of the thread's last run, finishing an interrupted run first; None without a checkpoint"""
+    agent = get_checkpointed_agent()
+    if agent is None:
+        return None
+    snapshot = agent.get_state({"configurable": {"thread_id": thread_id}})
+    if not snapshot.values:
+        return None
+    if snapshot.next:
+        # Interrupted mid-run: continue from the last completed node with a fresh time budget,
+        # since the checkpointed deadline expired long ago
+        agent.update_state({"configurable": {"thread_id": thread_id}}, start_request({}))
+        return run_agent(None, thread_id)
+    return snapshot.values
 
 # Helper function to create trial phase swimlane
 def create_phase_swimlane(phase_data):
@@ -1124,6 +3495,385 @@ def create_demographic_charts(age_data, gender_data, study_type_data, enrollment
     
     return charts
 
+# Cached chart construction: figures are built once per visualization_data hash
+@st.cache_data(max_entries=128, show_spinner=False)
+def build_chart_json(viz_ref: str, _viz_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Build phase and demographic charts for a result set and return them as serialized figure JSON"""
+    chart_json = {}
+    
+    phase_fig = create_phase_swimlane(_viz_data.get("phase_data", {}))
+    if phase_fig:
+        chart_json["phase"] = phase_fig.to_json()
+    
+    demographic_charts = create_demographic_charts(
+        _viz_data.get("age_data", {}),
+        _viz_data.get("gender_data", {}),
+        _viz_data.get("study_type_data", {}),
+        _viz_data.get("enrollment_sizes", [])
+    )
+    for name, chart in demographic_charts.items():
+        # Enrollment stats are plain numbers, everything else is a Plotly figure
+        chart_json[name] = chart if name == "enrollment_stats" else chart.to_json()
+    
+    return chart_json
+
+# Results browser: sort options map to a row field and direction
+RESULTS_SORT_OPTIONS = {
+    "Match score": ("score", True),
+    "Recently updated": ("last_update", True),
+    "Enrollment": ("enrollment", True),
+    "Phase": ("phase", False),
+    "Title": ("title", False)
+}
+RESULTS_PAGE_SIZES = [10, 25, 50]
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_results_table(results_ref: str, profile_key: str, _studies: List[Dict[str, Any]], _risk_assessments: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """One flat row per trial with the fields the results browser sorts and filters on"""
+    user_profile = json.loads(profile_key)
+    scores = get_scoring_model().score_batch(_studies, user_profile) if user_profile else [None] * len(_studies)
+    
+    rows = []
+    for study, score in zip(_studies, scores):
+        nct_id = study.get("nctId", "")
+        title = study.get("briefTitle", "")
+        conditions = study.get("conditionModule", {}).get("conditions", [])
+        rows.append({
+            "nctId": nct_id,
+            "title": title,
+            "search_text": " ".join([title, *conditions]).casefold(),
+            "phase": phase_label(study.get("designModule", {})),
+            "enrollment": study.get("designModule", {}).get("enrollmentInfo", {}).get("count", 0) or 0,
+            "last_update": study.get("lastUpdatePostDate", ""),
+            "risk_level": _risk_assessments.get(nct_id, {}).get("risk_level", "Unknown"),
+            "score": score,
+            "eligible": not (user_profile and criteria_conflicts(study.get("parsedCriteria", {}), user_profile))
+        })
+    return rows
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def query_results_table(results_ref: str, profile_key: str, sort_by: str, phases: tuple, risk_levels: tuple, text: str, eligible_only: bool, _rows: List[Dict[str, Any]]) -> List[int]:
+    """Row indices matching the browser filters, in sort order"""
+    text = text.strip().casefold()
+    matching = [
+        index for index, row in enumerate(_rows)
+        if (not phases or row["phase"] in phases)
+        and (not risk_levels or row["risk_level"] in risk_levels)
+        and (not text or text in row["search_text"])
+        and (not eligible_only or row["eligible"])
+    ]
+    field, descending = RESULTS_SORT_OPTIONS[sort_by]
+    # Python's sort is stable, so ties keep the API order
+    matching.sort(key=lambda index: _rows[index][field] if _rows[index][field] is not None else 0, reverse=descending)
+    return matching
+
+# Export: the full ranked result list streamed in chunks to CSV, JSONL or Parquet
+EXPORT_COLUMNS = [
+    "rank", "nctId", "briefTitle", "score", "eligible", "matchReasons", "riskLevel",
+    "phase", "studyType", "overallStatus", "conditions", "sponsor", "enrollment",
+    "lastUpdatePostDate", "siteCount", "sites", "url"
+]
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet"
+}
+EXPORT_CHUNK_ROWS = 500
+
+def export_rows(studies: List[Dict[str, Any]], user_profile: Dict[str, Any], risk_assessments: Dict[str, Any]):
+    """Yield one export row per trial, best matches first, building each row only when it is consumed"""
+    # Rank every trial, not just the top K; trials the criteria rule out go last
+    order = []
+    if user_profile:
+        scoring_model = get_scoring_model()
+        for index, study in enumerate(studies):
+            score, match_reasons = scoring_model.score(study, user_profile)
+            eligible = not criteria_conflicts(study.get("parsedCriteria", {}), user_profile)
+            order.append((not eligible, -score, index, score, match_reasons, eligible))
+        order.sort()
+    else:
+        order = [(False, 0, index, None, [], None) for index in range(len(studies))]
+    
+    for rank, (_, _, index, score, match_reasons, eligible) in enumerate(order, start=1):
+        study = studies[index]
+        nct_id = study.get("nctId", "")
+        design = study.get("designModule", {})
+        locations = study.get("locationsModule", {}).get("locations", [])
+        lead_sponsor = study.get("sponsorModule", {}).get("leadSponsor", {})
+        yield {
+            "rank": rank,
+            "nctId": nct_id,
+            "briefTitle": study.get("briefTitle", ""),
+            "score": score,
+            "eligible": eligible,
+            "matchReasons": "; ".join(match_reasons),
+            "riskLevel": risk_assessments.get(nct_id, {}).get("risk_level", ""),
+            "phase": phase_label(design),
+            "studyType": design.get("studyType", ""),
+            "overallStatus": study.get("overallStatus", ""),
+            "conditions": "; ".join(study.get("conditionModule", {}).get("conditions", [])),
+            "sponsor": lead_sponsor.get("name", ""),
+            "enrollment": design.get("enrollmentInfo", {}).get("count"),
+            "lastUpdatePostDate": study.get("lastUpdatePostDate", ""),
+            "siteCount": len(locations),
+            "sites": "; ".join(
+                " - ".join(part for part in [location.get("facility", ""), ", ".join(place for place in [location.get("city", ""), location.get("country", "")] if place)] if part)
+                for location in locations
+            ),
+            "url": f"https://clinicaltrials.gov/study/{nct_id}" if nct_id else ""
+        }
+
+def iter_chunks(rows, chunk_rows: int = EXPORT_CHUNK_ROWS):
+    """Group an iterable of rows into lists of at most chunk_rows"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def write_export(rows, export_format: str, output, chunk_rows: int = EXPORT_CHUNK_ROWS) -> int:
+    """Stream rows to a binary file object chunk by chunk; returns the number of rows written"""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{export_format}', expected one of {', '.join(EXPORT_FORMATS)}")
+    
+    written = 0
+    if export_format == "parquet":
+        if pa is None:
+            raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)")
+        schema = pa.schema([
+            ("rank", pa.int64()), ("nctId", pa.string()), ("briefTitle", pa.string()), ("score", pa.int64()),
+            ("eligible", pa.bool_()), ("matchReasons", pa.string()), ("riskLevel", pa.string()),
+            ("phase", pa.string()), ("studyType", pa.string()), ("overallStatus", pa.string()),
+            ("conditions", pa.string()), ("sponsor", pa.string()), ("enrollment", pa.int64()),
+            ("lastUpdatePostDate", pa.string()), ("siteCount", pa.int64()), ("sites", pa.string()), ("url", pa.string())
+        ])
+        with pq.ParquetWriter(output, schema) as writer:
+            for chunk in iter_chunks(rows, chunk_rows):
+                writer.write_batch(pa.RecordBatch.from_pylist(chunk, schema=schema))
+                written += len(chunk)
+        return written
+    
+    text_output = io.TextIOWrapper(output, encoding="utf-8", newline="", write_through=True)
+    try:
+        if export_format == "csv":
+            writer = csv.DictWriter(text_output, fieldnames=EXPORT_COLUMNS)
+            writer.writeheader()
+        for chunk in iter_chunks(rows, chunk_rows):
+            if export_format == "csv":
+                writer.writerows(chunk)
+            else:
+                text_output.write("".join(json.dumps(row) + "\n" for row in chunk))
+            written += len(chunk)
+    finally:
+        # Leave the caller's stream open
+        text_output.flush()
+        text_output.detach()
+    return written
+
+def export_results(state: Dict[str, Any], export_format: str, output) -> int:
+    """Export the ranked trials of a finished graph run"""
+    studies = state.get("api_results", {}).get("studies", [])
+    rows = export_rows(studies, state.get("user_profile", {}), state.get("risk_assessments", {}))
+    return write_export(rows, export_format, output)
+
+def export_file(state: Dict[str, Any], export_format: str):
+    """Export into an anonymous temp file, which the OS removes once it is closed"""
+    output = tempfile.TemporaryFile()
+    export_results(state, export_format, output)
+    output.seek(0)
+    return output
+
+# Profile matching the sidebar defaults, used when warming popular searches
+DEFAULT_USER_PROFILE = {
+    "age": 30,
+    "gender": "All",
+    "location": "",
+    "risk_tolerance": "low",
+    "travel_preference": "local"
+}
+
+# Background cache warmer: keeps popular searches hot in the shared caches
+class CacheWarmer(threading.Thread):
+    """Periodically pre-fetch, pre-aggregate and pre-summarize the most popular searches"""
+
+    def __init__(self, interval_seconds: float, top_n: int, model_name: str):
+        super().__init__(name="cache-warmer", daemon=True)
+        self.interval_seconds = interval_seconds
+        self.top_n = top_n
+        self.model_name = model_name
+        self.last_run = {}
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.last_errors = {}
+
+    def popular_searches(self) -> List:
+        """Top searches from the query log, topped up with the common conditions we know about"""
+        searches = get_query_log().top(self.top_n)
+        default_filters = build_search_filters(DEFAULT_USER_PROFILE)
+        for condition in DISEASE_EXPANSIONS:
+            if len(searches) >= self.top_n:
+                break
+            if (condition, default_filters) not in searches:
+                searches.append((condition, default_filters))
+        return searches
+
+    def warm(self, condition: str, filters: Dict[str, str]):
+        """Refresh one search in the response cache and pre-build its summary and charts"""
+        results = get_condition_results(
+            condition, filters, get_response_cache(), get_single_flight(), get_saved_search_store(), refresh=True
+        )
+        # Same shape as a live single-condition search, so prompts and chart keys match
+        state = {
+            "messages": [],
+            "selected_model": self.model_name,
+            "user_profile": {},
+            "api_results": {
+                "studies": [{**study, "matchedConditions": [condition]} for study in results["studies"]],
+                "totalCount": results["totalCount"]
+            }
+        }
+        if os.getenv("OPENAI_API_KEY") or get_llm_backend().name == "local":
+            summarize_eligibility(state)
+        prepare_visualizations(state)
+        viz_data = state["visualization_data"]
+        if viz_data:
+            build_chart_json(get_result_store().put(viz_data), viz_data)
+
+    def run(self):
+        current_session_id.set("cache-warmer")
+        while True:
+            for condition, filters in self.popular_searches():
+                try:
+                    self.warm(condition, filters)
+                    with self._lock:
+                        self.last_run[condition] = time.time()
+                        self.last_errors.pop(condition, None)
+                except Exception as e:
+                    logger.warning("Cache warmer failed for '%s': %s", condition, e)
+                    with self._lock:
+                        self.failures += 1
+                        self.last_errors[condition] = str(e)
+            time.sleep(self.interval_seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Warmed searches, failures and the latest error per failing search for the metrics panel"""
+        with self._lock:
+            return {
+                "warmed_searches": len(self.last_run),
+                "failures": self.failures,
+                "failing_searches": dict(self.last_errors)
+            }
+
+@st.cache_resource
+def start_cache_warmer():
+    """Start one background cache warmer per process (disabled when the interval is 0)"""
+    interval_seconds = float(os.getenv("CACHE_WARMER_INTERVAL_SECONDS", "600"))
+    if interval_seconds <= 0:
+        return None
+    warmer = CacheWarmer(
+        interval_seconds=interval_seconds,
+        top_n=int(os.getenv("CACHE_WARMER_TOP_N", "5")),
+        model_name=get_available_models()[0]
+    )
+    warmer.start()
+    return warmer
+
+# Trial card body shared by the results browser
+def show_trial_card(study: Dict[str, Any], show_matched_conditions: bool, section: str):
+    """Condition, status, phase, sponsor and links for one trial"""
+    st.write(f"**Condition:** {', '.join(study.get('conditionModule', {}).get('conditions', []))}")
+    if show_matched_conditions:
+        st.write(f"**Matched Searches:** {', '.join(study.get('matchedConditions', []))}")
+    st.write(f"**Status:** {study.get('overallStatus', 'Unknown')}")
+    
+    # Show phase information
+    design_module = study.get("designModule", {})
+    phases = design_module.get("phases", [])
+    study_type = design_module.get("studyType", "Unknown")
+    
+    if study_type == "OBSERVATIONAL":
+        st.write(f"**Type:** Observational Study")
+    elif phases and phases != ["NA"]:
+        phase_code = phases[0] if phases else "NA"
+        if phase_code == "PHASE1":
+            st.write(f"**Phase:** Phase 1")
+        elif phase_code == "PHASE2":
+            st.write(f"**Phase:** Phase 2")
+        elif phase_code == "PHASE3":
+            st.write(f"**Phase:** Phase 3")
+        elif phase_code == "PHASE4":
+            st.write(f"**Phase:** Phase 4")
+        elif phase_code == "EARLY_PHASE1":
+            st.write(f"**Phase:** Early Phase 1")
+        else:
+            st.write(f"**Phase:** {phase_code}")
+    else:
+        st.write(f"**Phase:** Not Applicable")
+    
+    # Show sponsor information
+    sponsor_module = study.get("sponsorModule", {})
+    lead_sponsor = sponsor_module.get("leadSponsor", {})
+    lead_sponsor_name = lead_sponsor.get("name", "Unknown")
+    lead_sponsor_class = lead_sponsor.get("class", "Unknown")
+    st.write(f"**Sponsor:** {lead_sponsor_name} ({lead_sponsor_class})")
+    
+    # Add link to ClinicalTrials.gov
+    nct_id = study.get('nctId', '')
+    if nct_id:
+        st.markdown(f"[View on ClinicalTrials.gov](https://clinicaltrials.gov/ct2/show/{nct_id})")
+    show_trial_details(study, section)
+
+# Full trial details, loaded when the user asks for them
+def show_trial_details(study: Dict[str, Any], section: str):
+    """Button that lazily loads and shows a trial's full record"""
+    nct_id = study.get("nctId", "")
+    if not nct_id:
+        return
+    opened = st.session_state.setdefault("opened_trials", set())
+    if nct_id not in opened:
+        if not st.button("📄 Load full details", key=f"details-{section}-{nct_id}"):
+            return
+        opened.add(nct_id)
+    
+    try:
+        details = get_trial_details(nct_id, study.get("lastUpdatePostDate", ""))
+    except Exception as e:
+        st.error(f"Error loading details for {nct_id}: {str(e)}")
+        return
+    
+    brief_summary = details["descriptionModule"].get("briefSummary", "")
+    if brief_summary:
+        st.write(f"**Summary:** {brief_summary}")
+    interventions = details["armsInterventionsModule"].get("interventions", [])
+    if interventions:
+        st.write("**Interventions:** " + ", ".join(f"{item.get('name', '')} ({item.get('type', '').lower()})" for item in interventions))
+    criteria = details["eligibilityModule"].get("eligibilityCriteria", "")
+    if criteria:
+        st.markdown(f"**Eligibility Criteria:**\n\n{criteria}")
+    locations = details["locationsModule"].get("locations", [])
+    if locations:
+        st.write(f"**Locations ({len(locations)}):**")
+        for location in locations[:10]:
+            place = ", ".join(part for part in [location.get("city", ""), location.get("state", ""), location.get("country", "")] if part)
+            st.write(f"• {location.get('facility', 'Unknown facility')} - {place}")
+    for contact in details["locationsModule"].get("centralContacts", [])[:2]:
+        st.write(f"**Contact:** {contact.get('name', '')} {contact.get('phone', '')} {contact.get('email', '')}".strip())
+
+# Service metrics shown to operators in the sidebar
+def collect_service_metrics() -> Dict[str, Any]:
+    """Snapshot of process-wide routing and cache statistics"""
+    warmer = start_cache_warmer()
+    return {
+        "llm_latency": get_llm_latency_stats().snapshot(),
+        "rate_limits": get_rate_limiter().snapshot(),
+        "circuit_breakers": get_circuit_breaker().snapshot(),
+        "criteria_index": get_criteria_index().snapshot(),
+        "cache_warmer": warmer.snapshot() if warmer else "disabled"
+    }
+
 # Main Streamlit app
 def main():
     st.markdown('<h1 class="main-header">🏥 Patient & Caregiver Trial Navigator</h1>', unsafe_allow_html=True)
@@ -1142,6 +3892,18 @@ def main():
         if available_models:
             selected_model = available_models[0]  # Use first available model
     
+    # Keep popular searches warm in the background
+    start_cache_warmer()
+    
+    # After a browser reload or server restart, pick up the session's last checkpoint instead of recomputing
+    session_id = get_session_id()
+    if "session_restored" not in st.session_state:
+        st.session_state.session_restored = True
+        restored_state = restore_session(session_id)
+        if restored_state:
+            st.session_state.agent_state = dehydrate_state(restored_state, st.session_state.result_payloads)
+            st.session_state.messages = compact_messages([message for message in restored_state.get("messages", []) if isinstance(message, HumanMessage)])
+    
     # User profile sidebar
     with st.sidebar:
         st.markdown("### 👤 User Profile & Preferences")
@@ -1207,6 +3969,23 @@ def main():
             elif user_risk_tolerance == "high":
                 st.info("🔴 **High Risk**: You'll see Phase 1-2 trials with cutting-edge experimental treatments")
             
+            user_phases = st.multiselect(
+                "Only Show These Phases (optional)",
+                list(PHASE_LABELS.keys()),
+                format_func=lambda x: PHASE_LABELS[x],
+                help="Leave empty to see all phases; selected phases are filtered by the trial search itself"
+            )
+            
+            st.markdown("**Clinical Details (optional):**")
+            st.caption("Used to rule out trials whose eligibility criteria you would not meet. Leave blank if unsure.")
+            user_hba1c = st.text_input("HbA1c (%)", placeholder="e.g., 7.5", help="Your most recent HbA1c result, if known")
+            user_ecog = st.selectbox(
+                "ECOG Performance Status",
+                ["Not specified", 0, 1, 2, 3, 4],
+                help="0 = fully active, 4 = completely disabled"
+            )
+            user_pregnant = st.checkbox("Currently pregnant or breastfeeding") if user_gender != "Male" else False
+            
             st.markdown("**Travel Preferences:**")
             
             # Add explanation for travel preferences
@@ -1251,6 +4030,17 @@ def main():
                 "risk_tolerance": user_risk_tolerance,
                 "travel_preference": user_travel_preference
             }
+            # Clinical details are only set when the user provides them
+            try:
+                st.session_state.agent_state["user_profile"]["hba1c"] = float(user_hba1c)
+            except ValueError:
+                pass
+            if user_ecog != "Not specified":
+                st.session_state.agent_state["user_profile"]["ecog"] = user_ecog
+            if user_pregnant:
+                st.session_state.agent_state["user_profile"]["pregnant"] = True
+            if user_phases:
+                st.session_state.agent_state["user_profile"]["phases"] = user_phases
             
             # Show profile summary (only once)
             if user_age or user_gender or user_location:
@@ -1289,6 +4079,10 @@ def main():
         - 🎯 **Personalized Matching**
         - ⚠️ **Risk Assessment**
         """)
+        
+        # Operator view of upstream latency and shared state
+        with st.expander("🔧 Service Metrics", expanded=False):
+            st.json(collect_service_metrics())
     
     # ===== CHAT SECTION AT TOP =====
     st.markdown('<h2 class="sub-header">💬 Chat with Trial Navigator</h2>', unsafe_allow_html=True)
@@ -1321,56 +4115,58 @@ def main():
             
             # Run the agent
             with st.spinner("Searching for clinical trials..."):
-                agent = get_agent()
-                final_state = agent.invoke(st.session_state.agent_state)
-                st.session_state.agent_state = final_state
+                final_state = run_agent(start_request(hydrate_state(st.session_state.agent_state, st.session_state.result_payloads)), thread_id=session_id)
+                # Keep only references to heavy results and a bounded message log in the session
+                st.session_state.agent_state = dehydrate_state(final_state, st.session_state.result_payloads)
+                st.session_state.messages = compact_messages(st.session_state.messages)
             
             # Rerun to show new messages
             st.rerun()
     
+    # Resolve stored result references once per rerun
+    agent_state = hydrate_state(st.session_state.agent_state, st.session_state.result_payloads)
+    
+    # Charts are keyed on the stored visualization_data reference, so reruns reuse built figures
+    viz_data = agent_state.get("visualization_data", {})
+    viz_ref = state_ref(st.session_state.agent_state, "visualization_data") or result_hash(viz_data)
+    chart_json = build_chart_json(viz_ref, viz_data) if viz_data else {}
+    
     # ===== TWO COLUMNS BELOW CHAT: TRIAL ANALYSIS & VISUALIZATIONS =====
-    if st.session_state.agent_state.get("api_results"):
-        api_results = st.session_state.agent_state["api_results"]
+    if agent_state.get("api_results"):
+        api_results = agent_state["api_results"]
         studies = api_results.get("studies", [])
         
         if studies:
             total_count = api_results.get("totalCount", len(studies))
             
             # Check if user has a profile and show personalized info
-            user_profile = st.session_state.agent_state.get("user_profile", {})
+            user_profile = agent_state.get("user_profile", {})
             if user_profile and any(user_profile.values()):
-                # Calculate how many trials match the user's profile
-                matching_trials = 0
-                for study in studies:
-                    eligibility = study.get("eligibilityModule", {})
-                    min_age = eligibility.get("minimumAge", 0)
-                    max_age = eligibility.get("maximumAge", 100)
-                    sex = eligibility.get("sex", "ALL")
-                    
-                    # Check age match using helper function
-                    user_age = int(user_profile.get("age", 30))
-                    min_age = parse_age(min_age)
-                    max_age = parse_age(max_age)
-                    age_match = min_age <= user_age <= max_age
-                    
-                    # Check gender match
-                    gender_match = sex == "ALL" or sex == user_profile.get("gender", "All").upper()
-                    
-                    if age_match and gender_match:
-                        matching_trials += 1
+                # Profile match counts come precomputed from the aggregation engine
+                profile_stats = get_profile_aggregates(agent_state)
+                matching_trials = profile_stats.get("matching_trials", 0)
                 
                 st.success(f"✅ Found {len(studies)} recruiting trials")
                 st.info(f"🎯 **{matching_trials} trials match your profile** (age {user_profile.get('age')}, {user_profile.get('gender')}, {user_profile.get('risk_tolerance')} risk, {user_profile.get('travel_preference')} travel)")
                 st.info(f"📊 Total available: {total_count} trials (showing first {len(studies)})")
+                if api_results.get("filters"):
+                    st.caption(f"🔎 Search filtered by your profile: {'; '.join(f'{name} = {value}' for name, value in api_results['filters'].items())}")
             else:
                 st.success(f"✅ Found {len(studies)} recruiting trials (showing up to 50 results)")
                 if total_count > len(studies):
                     st.info(f"📊 Total available: {total_count} trials (showing first {len(studies)})")
             
+            if api_results.get("updatedTrials"):
+                st.info(f"🆕 {len(api_results['updatedTrials'])} trials are new or updated since this search was last run")
+            
+            # Steps that gave way to the search's time budget
+            if agent_state.get("degraded"):
+                st.warning(f"⏱️ Some steps were shortened to answer within {SEARCH_BUDGET_SECONDS:.0f}s: {'; '.join(agent_state['degraded'])}")
+            
             # Interactive trial locations map
-            if st.session_state.agent_state.get("visualization_data", {}).get("map_data"):
+            if agent_state.get("visualization_data", {}).get("map_data"):
                 st.subheader("🌍 Interactive Trial Locations Map")
-                map_data = st.session_state.agent_state["visualization_data"]["map_data"]
+                map_data = agent_state["visualization_data"]["map_data"]
                 if map_data and any("lat" in item and "lon" in item for item in map_data):
                     # Create interactive map with folium
                     m = folium.Map(location=[39.8283, -98.5795], zoom_start=4)
@@ -1418,44 +4214,38 @@ def main():
                 st.info("📍 Location data not available for these trials")
             
             # Trial phase swimlane visualization
-            if st.session_state.agent_state.get("visualization_data", {}).get("phase_data"):
+            if agent_state.get("visualization_data", {}).get("phase_data"):
                 st.subheader("📊 Trial Phase Distribution")
-                phase_data = st.session_state.agent_state["visualization_data"]["phase_data"]
+                phase_data = agent_state["visualization_data"]["phase_data"]
                 if phase_data:
-                    fig = create_phase_swimlane(phase_data)
-                    if fig:
-                        st.plotly_chart(fig, use_container_width=True)
+                    if "phase" in chart_json:
+                        st.plotly_chart(json.loads(chart_json["phase"]), use_container_width=True)
                 else:
                     st.info("📊 Phase information not available for these trials")
             else:
                 st.info("📊 Phase information not available for these trials")
             
             # Demographic visualizations
-            if st.session_state.agent_state.get("visualization_data"):
-                viz_data = st.session_state.agent_state["visualization_data"]
+            if agent_state.get("visualization_data"):
+                viz_data = agent_state["visualization_data"]
                 
                 if any(key in viz_data for key in ["age_data", "gender_data", "study_type_data", "enrollment_sizes"]):
                     st.subheader("📊 Demographic & Eligibility Analysis")
                     
-                    # Create demographic charts
-                    demographic_charts = create_demographic_charts(
-                        viz_data.get("age_data", {}),
-                        viz_data.get("gender_data", {}),
-                        viz_data.get("study_type_data", {}),
-                        viz_data.get("enrollment_sizes", [])
-                    )
+                    # Use the cached demographic charts
+                    demographic_charts = chart_json
                     
                     # Display charts in columns
                     if "age" in demographic_charts:
                         col1, col2 = st.columns(2)
                         with col1:
-                            st.plotly_chart(demographic_charts["age"], use_container_width=True)
+                            st.plotly_chart(json.loads(demographic_charts["age"]), use_container_width=True)
                         with col2:
                             if "gender" in demographic_charts:
-                                st.plotly_chart(demographic_charts["gender"], use_container_width=True)
+                                st.plotly_chart(json.loads(demographic_charts["gender"]), use_container_width=True)
                     
                     if "study_type" in demographic_charts:
-                        st.plotly_chart(demographic_charts["study_type"], use_container_width=True)
+                        st.plotly_chart(json.loads(demographic_charts["study_type"]), use_container_width=True)
                     
                     # Display enrollment statistics
                     if "enrollment_stats" in demographic_charts:
@@ -1463,35 +4253,16 @@ def main():
                         stats = demographic_charts["enrollment_stats"]
                         
                         # Check if user has a profile for personalized stats
-                        user_profile = st.session_state.agent_state.get("user_profile", {})
+                        user_profile = agent_state.get("user_profile", {})
                         if user_profile and any(user_profile.values()):
-                            # Calculate personalized enrollment stats
-                            matching_enrollments = []
-                            for study in studies:
-                                eligibility = study.get("eligibilityModule", {})
-                                min_age = eligibility.get("minimumAge", 0)
-                                max_age = eligibility.get("maximumAge", 100)
-                                sex = eligibility.get("sex", "ALL")
-                                
-                                # Check age and gender match using helper function
-                                user_age = int(user_profile.get("age", 30))
-                                min_age = parse_age(min_age)
-                                max_age = parse_age(max_age)
-                                age_match = min_age <= user_age <= max_age
-                                gender_match = sex == "ALL" or sex == user_profile.get("gender", "All").upper()
-                                
-                                if age_match and gender_match:
-                                    design = study.get("designModule", {})
-                                    enrollment_info = design.get("enrollmentInfo", {})
-                                    enrollment_count = enrollment_info.get("count", 0)
-                                    if enrollment_count > 0:
-                                        matching_enrollments.append(enrollment_count)
+                            # Personalized enrollment stats come precomputed from the aggregation engine
+                            matching_stats = get_profile_aggregates(agent_state).get("enrollment_stats", {})
                             
-                            if matching_enrollments:
-                                matching_total = sum(matching_enrollments)
-                                matching_avg = matching_total // len(matching_enrollments)
-                                matching_max = max(matching_enrollments)
-                                matching_min = min(matching_enrollments)
+                            if matching_stats:
+                                matching_total = matching_stats["Total Enrollment"]
+                                matching_avg = matching_stats["Average Enrollment"]
+                                matching_max = matching_stats["Largest Study"]
+                                matching_min = matching_stats["Smallest Study"]
                                 
                                 st.info(f"🎯 **Personalized for {user_profile.get('age')}-year-old {user_profile.get('gender')}**")
                                 col1, col2, col3, col4 = st.columns(4)
@@ -1525,67 +4296,80 @@ def main():
             # ===== TRIAL DETAILS & RECOMMENDATIONS SECTION =====
             
             # Simplified eligibility criteria - full width
-            if st.session_state.agent_state.get("simplified_criteria"):
+            if agent_state.get("simplified_criteria"):
                 st.subheader("✅ Simplified Eligibility Criteria")
-                st.write(st.session_state.agent_state["simplified_criteria"])
+                st.write(agent_state["simplified_criteria"])
             
-            # Sample Trials - full width
-            st.subheader("📋 Sample Trials")
-            for i, study in enumerate(studies[:3]):  # Show first 3 trials
-                with st.expander(f"{study.get('briefTitle', 'Unknown Trial')[:60]}..."):
-                    st.write(f"**Condition:** {', '.join(study.get('conditionModule', {}).get('conditions', []))}")
-                    st.write(f"**Status:** {study.get('overallStatus', 'Unknown')}")
-                    
-                    # Show phase information
-                    design_module = study.get("designModule", {})
-                    phases = design_module.get("phases", [])
-                    study_type = design_module.get("studyType", "Unknown")
-                    
-                    if study_type == "OBSERVATIONAL":
-                        st.write(f"**Type:** Observational Study")
-                    elif phases and phases != ["NA"]:
-                        phase_code = phases[0] if phases else "NA"
-                        if phase_code == "PHASE1":
-                            st.write(f"**Phase:** Phase 1")
-                        elif phase_code == "PHASE2":
-                            st.write(f"**Phase:** Phase 2")
-                        elif phase_code == "PHASE3":
-                            st.write(f"**Phase:** Phase 3")
-                        elif phase_code == "PHASE4":
-                            st.write(f"**Phase:** Phase 4")
-                        elif phase_code == "EARLY_PHASE1":
-                            st.write(f"**Phase:** Early Phase 1")
-                        else:
-                            st.write(f"**Phase:** {phase_code}")
-                    else:
-                        st.write(f"**Phase:** Not Applicable")
-                    
-                    # Show sponsor information
-                    sponsor_module = study.get("sponsorModule", {})
-                    lead_sponsor = sponsor_module.get("leadSponsor", {})
-                    lead_sponsor_name = lead_sponsor.get("leadSponsorName", "Unknown")
-                    lead_sponsor_class = lead_sponsor.get("leadSponsorClass", "Unknown")
-                    st.write(f"**Sponsor:** {lead_sponsor_name} ({lead_sponsor_class})")
-                    
-                    # Add link to ClinicalTrials.gov
-                    nct_id = study.get('nctId', '')
-                    if nct_id:
-                        st.markdown(f"[View on ClinicalTrials.gov](https://clinicaltrials.gov/ct2/show/{nct_id})")
+            # All trials - paginated browser over the precomputed results table
+            st.subheader("📋 All Trials")
+            updated_trials = set(api_results.get("updatedTrials", []))
+            results_ref = state_ref(st.session_state.agent_state, "api_results") or result_hash(api_results)
+            profile_key = json.dumps(user_profile, sort_keys=True)
+            results_table = build_results_table(results_ref, profile_key, studies, agent_state.get("risk_assessments", {}))
+            
+            sort_col, phase_col, risk_col = st.columns(3)
+            with sort_col:
+                sort_options = list(RESULTS_SORT_OPTIONS) if user_profile else [option for option in RESULTS_SORT_OPTIONS if option != "Match score"]
+                sort_by = st.selectbox("Sort by", sort_options, key="results_sort")
+            with phase_col:
+                phase_filter = st.multiselect("Phase", sorted(set(row["phase"] for row in results_table)), key="results_phases")
+            with risk_col:
+                risk_filter = st.multiselect("Risk level", sorted(set(row["risk_level"] for row in results_table)), key="results_risks")
+            text_col, eligible_col, size_col = st.columns(3)
+            with text_col:
+                text_filter = st.text_input("Title or condition contains", key="results_text")
+            with eligible_col:
+                eligible_only = st.checkbox("Hide trials my criteria rule out", value=False, key="results_eligible", disabled=not user_profile)
+            with size_col:
+                page_size = st.selectbox("Per page", RESULTS_PAGE_SIZES, key="results_page_size")
+            
+            matching_rows = query_results_table(results_ref, profile_key, sort_by, tuple(phase_filter), tuple(risk_filter), text_filter, eligible_only, results_table)
+            page_count = max(1, -(-len(matching_rows) // page_size))
+            page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1, key=f"results_page-{results_ref}")
+            st.caption(f"Showing {min(len(matching_rows), (page - 1) * page_size + 1)}-{min(len(matching_rows), page * page_size)} of {len(matching_rows)} matching trials")
+            
+            # Only the visible page is rendered
+            for row_index in matching_rows[(page - 1) * page_size:page * page_size]:
+                row = results_table[row_index]
+                new_marker = "🆕 " if row["nctId"] in updated_trials else ""
+                score_label = f" - Score: {row['score']}" if row["score"] is not None else ""
+                with st.expander(f"{new_marker}{row['title'][:60]}... ({row['risk_level']} risk{score_label})"):
+                    show_trial_card(studies[row_index], len(api_results.get("conditions", [])) > 1, "browse")
+            
+            # Export of the full ranked list, written in chunks only when the download is clicked
+            format_col, download_col = st.columns(2)
+            with format_col:
+                export_format = st.selectbox("Export format", list(EXPORT_FORMATS), key="export_format")
+            with download_col:
+                st.download_button(
+                    "⬇️ Download results",
+                    lambda: export_file(agent_state, export_format),
+                    file_name=f"trials_{normalize_query(agent_state.get('disease_name', 'results')).replace(' ', '_')}.{export_format}",
+                    mime=EXPORT_FORMATS[export_format],
+                    key="export_download"
+                )
             
             # Personalized recommendations - full width
-            if st.session_state.agent_state.get("personalized_recommendations"):
+            if agent_state.get("personalized_recommendations"):
                 st.subheader("🎯 Personalized Recommendations")
-                recommendations = st.session_state.agent_state["personalized_recommendations"]
+                recommendations = agent_state["personalized_recommendations"]
                 
                 if recommendations:
                     st.success(f"✨ Found {len(recommendations)} matching trials!")
                     
-                    # Show top 3 recommendations
-                    for i, rec in enumerate(recommendations[:3]):
+                    # Paginated like the results browser, sharing its page size
+                    recommendation_pages = max(1, -(-len(recommendations) // page_size))
+                    recommendation_page = st.number_input(
+                        f"Recommendations page (of {recommendation_pages})", min_value=1, max_value=recommendation_pages, value=1, step=1,
+                        key=f"recommendations_page-{results_ref}"
+                    )
+                    first_rank = (recommendation_page - 1) * page_size
+                    for i, rec in enumerate(recommendations[first_rank:first_rank + page_size], start=first_rank):
                         trial = rec["trial"]
                         score = rec["score"]
                         
-                        with st.expander(f"🥇 #{i+1} - Score: {score}"):
+                        new_marker = " 🆕" if trial.get("nctId") in updated_trials else ""
+                        with st.expander(f"🥇 #{i+1} - Score: {score}{new_marker}"):
                             st.write(f"**Match Score:** {score}/100")
                             st.write(f"**NCT ID:** {trial.get('nctId', 'Unknown')}")
                             
@@ -1593,19 +4377,27 @@ def main():
                             nct_id = trial.get('nctId', '')
                             if nct_id:
                                 st.markdown(f"[View on ClinicalTrials.gov](https://clinicaltrials.gov/ct2/show/{nct_id})")
+                            show_trial_details(trial, "recommended")
                 else:
                     st.info("💡 Set your profile in sidebar for personalized recommendations.")
             
             # Risk assessments summary
-            if st.session_state.agent_state.get("risk_assessments"):
+            if agent_state.get("risk_assessments"):
                 st.subheader("⚠️ Risk Summary")
-                risk_assessments = st.session_state.agent_state["risk_assessments"]
+                risk_assessments = agent_state["risk_assessments"]
                 
                 if risk_assessments:
-                    st.info(f"🔍 Risk analysis: {len(risk_assessments)} trials")
+                    # Counts cover every trial; details are rendered only for the displayed ones
+                    risk_counts = Counter(assessment["risk_level"] for assessment in risk_assessments.values())
+                    st.info(f"🔍 Risk analysis: {len(risk_assessments)} trials - " + ", ".join(f"{count} {level}" for level, count in risk_counts.most_common()))
                     
-                    # Show risk summary
-                    for nct_id, assessment in risk_assessments.items():
+                    # Show the recommended trials first, else the first few results
+                    displayed_ids = [rec["trial"].get("nctId", "") for rec in agent_state.get("personalized_recommendations", [])]
+                    displayed_ids = displayed_ids or [study.get("nctId", "") for study in studies]
+                    for nct_id in displayed_ids[:5]:
+                        assessment = risk_assessments.get(nct_id)
+                        if assessment is None:
+                            continue
                         risk_level = assessment["risk_level"]
                         title = assessment["title"][:50] + "..." if len(assessment["title"]) > 50 else assessment["title"]
                         
@@ -1619,7 +4411,8 @@ def main():
                         else:
                             color = "🟢"
                         
-                        st.write(f"{color} {title} - {risk_level}")
+                        with st.expander(f"{color} {title} - {risk_level}"):
+                            st.markdown(render_risk_summary(assessment))
         
         else:
             st.warning("No recruiting trials found for the specified condition.")
@@ -1628,8 +4421,8 @@ def main():
     
     # ===== STORY JOURNEY: HOW REFLEXION IMPROVED YOUR RESULTS =====
     # This section is now full-width, outside the columns
-    if st.session_state.agent_state.get("api_results") and st.session_state.agent_state["api_results"].get("studies"):
-        studies = st.session_state.agent_state["api_results"]["studies"]
+    if agent_state.get("api_results") and agent_state["api_results"].get("studies"):
+        studies = agent_state["api_results"]["studies"]
         
         st.markdown("---")
         st.subheader("🚀 **Your Trial Search Journey Story**")
@@ -1674,7 +4467,7 @@ def main():
                     **Your reaction:** "Wow, it's actually considering what I want!"
                     """)
                 with col2:
-                    user_profile = st.session_state.agent_state.get("user_profile", {})
+                    user_profile = agent_state.get("user_profile", {})
                     if user_profile and any(user_profile.values()):
                         st.metric("Profile Match", "Active", delta="Smart!")
                     else:
@@ -1693,8 +4486,8 @@ def main():
                     **Your reaction:** "It's like having a quality inspector for my search!"
                     """)
                 with col2:
-                    if st.session_state.agent_state.get("quality_metrics"):
-                        quality_metrics = st.session_state.agent_state["quality_metrics"]
+                    if agent_state.get("quality_metrics"):
+                        quality_metrics = agent_state["quality_metrics"]
                         score = quality_metrics.get("score", 0)
                         if score >= 75:
                             st.metric("Quality Score", f"{score}%", delta="Excellent!", delta_color="normal")
@@ -1718,8 +4511,8 @@ def main():
                     **Your reaction:** "This is exactly what I was looking for!"
                     """)
                 with col2:
-                    if st.session_state.agent_state.get("personalized_recommendations"):
-                        recs = st.session_state.agent_state["personalized_recommendations"]
+                    if agent_state.get("personalized_recommendations"):
+                        recs = agent_state["personalized_recommendations"]
                         st.metric("Smart Matching", f"{len(recs)}", delta="Perfect!")
                     else:
                         st.metric("Smart Matching", "In Progress", delta="Working")
@@ -1754,8 +4547,8 @@ def main():
                 st.metric("🔍 **Trials Found**", f"{len(studies)}", delta="Total Results")
             
             with col2:
-                if st.session_state.agent_state.get("personalized_recommendations"):
-                    recs = st.session_state.agent_state["personalized_recommendations"]
+                if agent_state.get("personalized_recommendations"):
+                    recs = agent_state["personalized_recommendations"]
                     st.metric("🎯 **Smart Matches**", f"{len(recs)}", delta="Tailored for You")
                 else:
                     st.metric("🎯 **Smart Matches**", "In Progress", delta="Working")
@@ -1775,5 +4568,117 @@ def main():
         
         # ===== END STORY JOURNEY =====
 
+# Headless load test: run the full graph for many concurrent sessions
+def run_load_test(disease: str, sessions: int, concurrency: int, user_profile: Dict[str, Any] = None, use_async: bool = False) -> Dict[str, Any]:
+    """Invoke the agent graph for many sessions in parallel and report latency percentiles"""
+    agent = get_agent(use_async)
+    
+    def new_session_state():
+        state = start_request(new_agent_state())
+        state["disease_name"] = disease
+        state["user_profile"] = dict(user_profile or DEFAULT_USER_PROFILE)
+        return state
+    
+    def run_session(session_index):
+        current_session_id.set(f"loadtest-{session_index}")
+        state = new_session_state()
+        started = time.time()
+        final_state = agent.invoke(state)
+        return time.time() - started, bool(final_state.get("degraded"))
+    
+    async def run_async_sessions():
+        # One event loop multiplexes every session, at most `concurrency` in flight
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def run_async_session(session_index):
+            current_session_id.set(f"loadtest-{session_index}")
+            async with semaphore:
+                state = new_session_state()
+                started = time.time()
+                final_state = await agent.ainvoke(state)
+                return time.time() - started, bool(final_state.get("degraded"))
+        
+        return await asyncio.gather(*(run_async_session(session_index) for session_index in range(sessions)))
+    
+    started = time.time()
+    if use_async:
+        outcomes = asyncio.run(run_async_sessions())
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            outcomes = list(pool.map(run_session, range(sessions)))
+    elapsed = time.time() - started
+    latencies = sorted(latency for latency, _ in outcomes)
+    
+    return {
+        "sessions": sessions,
+        "concurrency": concurrency,
+        "mode": "async" if use_async else "threads",
+        "elapsed_seconds": round(elapsed, 3),
+        "sessions_per_second": round(sessions / elapsed, 2),
+        "p50_seconds": round(percentile(latencies, 0.5), 3),
+        "p95_seconds": round(percentile(latencies, 0.95), 3),
+        "max_seconds": round(latencies[-1], 3),
+        "degraded_sessions": sum(1 for _, degraded in outcomes if degraded),
+        "llm_latency": get_llm_latency_stats().snapshot()
+    }
+
+def run_cli(argv: List[str]):
+    """Headless commands: python app.py <command> ..."""
+    import argparse
+    parser = argparse.ArgumentParser(prog="app.py", description="Trial Navigator headless commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    
+    load_test = commands.add_parser("loadtest", help="Run the full agent graph for many concurrent sessions")
+    load_test.add_argument("disease", help="Condition to search for")
+    load_test.add_argument("--sessions", type=int, default=50)
+    load_test.add_argument("--concurrency", type=int, default=10)
+    load_test.add_argument("--local-llm", action="store_true", help="Use the local deterministic LLM backend")
+    load_test.add_argument("--async", dest="use_async", action="store_true", help="Run all sessions on one event loop via ainvoke")
+    
+    export = commands.add_parser("export", help="Search headlessly and stream the ranked trials to a file")
+    export.add_argument("disease", help="Condition to search for")
+    export.add_argument("--format", choices=list(EXPORT_FORMATS), default="csv")
+    export.add_argument("--output", default="-", help="Output file, '-' for stdout")
+    export.add_argument("--age", type=int)
+    export.add_argument("--gender", choices=["All", "Male", "Female"])
+    export.add_argument("--location", help="City, Country")
+    export.add_argument("--risk-tolerance", choices=["low", "moderate", "high"])
+    export.add_argument("--travel-preference", choices=["local", "regional", "national", "international"])
+    export.add_argument("--local-llm", action="store_true", help="Use the local deterministic LLM backend")
+    
+    args = parser.parse_args(argv)
+    if args.local_llm:
+        os.environ["LLM_BACKEND"] = "local"
+        get_llm_backend.clear()
+    
+    if args.command == "export":
+        state = start_request(new_agent_state())
+        state["disease_name"] = args.disease
+        profile = {
+            "age": args.age,
+            "gender": args.gender,
+            "location": args.location,
+            "risk_tolerance": args.risk_tolerance,
+            "travel_preference": args.travel_preference
+        }
+        state["user_profile"] = {key: value for key, value in profile.items() if value is not None}
+        final_state = get_agent().invoke(state)
+        for step in final_state.get("degraded", []):
+            print(f"Degraded: {step}", file=sys.stderr)
+        if args.output == "-":
+            written = export_results(final_state, args.format, sys.stdout.buffer)
+        else:
+            with open(args.output, "wb") as output:
+                written = export_results(final_state, args.format, output)
+        print(f"Exported {written} trials", file=sys.stderr)
+    elif args.command == "loadtest":
+        print(json.dumps(run_load_test(args.disease, args.sessions, args.concurrency, use_async=args.use_async), indent=2))
+
+# Commands handled headlessly instead of starting the Streamlit UI
+CLI_COMMANDS = ["loadtest", "export"]
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        run_cli(sys.argv[1:])
+    else:
+        main()
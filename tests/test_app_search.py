@@ -0,0 +1,83 @@
+import copy
+import os
+
+import httpx
+import pytest
+import requests
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def study(nct_id):
+    return {
+        "protocolSection": {
+            "identificationModule": {"nctId": nct_id, "briefTitle": f"Asthma study {nct_id}"},
+            "statusModule": {
+                "overallStatus": "RECRUITING",
+                "studyFirstPostDateStruct": {"date": "2024-01-15"},
+                "lastUpdatePostDateStruct": {"date": "2024-06-01"}
+            },
+            "conditionsModule": {"conditions": ["Asthma"]},
+            "sponsorCollaboratorsModule": {"leadSponsor": {"name": "Example University", "class": "OTHER"}},
+            "contactsLocationsModule": {"locations": [{"facility": "Clinic", "city": "Boston", "state": "Massachusetts", "country": "United States"}]},
+            "designModule": {"studyType": "INTERVENTIONAL", "phases": ["PHASE2"], "enrollmentInfo": {"count": 120}},
+            "eligibilityModule": {
+                "sex": "ALL", "minimumAge": "18 Years", "maximumAge": "65 Years", "healthyVolunteers": False,
+                "eligibilityCriteria": "Inclusion Criteria:\n* Age 18 to 65 years\n\nExclusion Criteria:\n* Current smoker"
+            }
+        }
+    }
+
+
+PAGE = {"studies": [study(f"NCT{index:08d}") for index in range(3)], "totalCount": 3}
+
+
+def page_for(params):
+    """The fake API's page for a list request or a criteria request, honouring the field projection"""
+    params = params or {}
+    page = copy.deepcopy(PAGE)
+    if params.get("filter.ids"):
+        page["studies"] = [item for item in page["studies"] if item["protocolSection"]["identificationModule"]["nctId"] in params["filter.ids"].split(",")]
+    elif "EligibilityCriteria" not in params.get("fields", ""):
+        for item in page["studies"]:
+            del item["protocolSection"]["eligibilityModule"]["eligibilityCriteria"]
+    return page
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """App with the local LLM backend and a fake ClinicalTrials.gov, storing its databases under tmp_path"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setenv("LLM_BACKEND", "local")
+    monkeypatch.setenv("CACHE_WARMER_INTERVAL_SECONDS", "0")
+
+    async def fake_async_get(self, url, params=None, **kwargs):
+        return httpx.Response(200, json=page_for(params), request=httpx.Request("GET", url))
+
+    def fake_get(url, params=None, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = httpx.Response(200, json=page_for(params)).content
+        return response
+
+    monkeypatch.setattr(httpx.AsyncClient, "get", fake_async_get)
+    monkeypatch.setattr(requests, "get", fake_get)
+    # Every run starts with cold resource caches, as in a fresh server process
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    yield AppTest.from_file(APP_PATH, default_timeout=60)
+    st.cache_resource.clear()
+    st.cache_data.clear()
+
+
+@pytest.mark.parametrize("async_graph", ["true", "false"])
+def test_search_runs_with_cold_caches(app, monkeypatch, async_graph):
+    monkeypatch.setenv("ASYNC_GRAPH", async_graph)
+    app.run()
+    app.chat_input[0].set_value("asthma").run()
+    assert not app.exception
+    assert not app.error
+    assert any("Found 3 recruiting trials" in element.value for element in app.success)
@@ -0,0 +1,48 @@
+import pytest
+
+from app import parse_eligibility_criteria
+
+
+# Bounds of other measures in the same bullet must not be read as age bounds
+@pytest.mark.parametrize("text, expected", [
+    ("Inclusion Criteria:\n* Age ≥ 18 years, HbA1c 7-10%", {"age": {"min": 18.0}, "hba1c": {"min": 7.0, "max": 10.0}}),
+    ("Inclusion Criteria:\n* Adults with stage 3 CKD (eGFR 30-59)", {}),
+    ("Inclusion Criteria:\n* Adults aged ≥ 18 years, with BMI 25-40", {"age": {"min": 18.0}}),
+    ("Exclusion Criteria:\n* Women of childbearing age not using effective contraception for at least 30 days", {}),
+])
+def test_bounds_stay_within_keyword_clause(text, expected):
+    assert parse_eligibility_criteria(text)["constraints"] == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Inclusion Criteria:\n* Aged 18-65", {"age": {"min": 18.0, "max": 65.0}}),
+    ("Inclusion Criteria:\n* Adults 18 to 75 years", {"age": {"min": 18.0, "max": 75.0}}),
+    ("Inclusion Criteria:\n* Participants must be 18 years of age or older", {"age": {"min": 18.0}}),
+    ("Inclusion Criteria:\n* ECOG performance status 0 or 1", {"ecog": {"min": 0.0, "max": 1.0}}),
+    ("Exclusion Criteria:\n* Age > 80 years\n* ECOG ≥ 3", {"age": {"max": 80.0}, "ecog": {"max": 2.0}}),
+])
+def test_bounds_next_to_keyword(text, expected):
+    assert parse_eligibility_criteria(text)["constraints"] == expected
+
+
+def test_age_needs_years_unit_after_non_age_keyword():
+    assert parse_eligibility_criteria("Inclusion Criteria:\n* Adults 18-65")["constraints"] == {}
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Inclusion Criteria:\n* HbA1c ≥ 7.0% and ≤ 10.5%", {"hba1c": {"min": 7.0, "max": 10.5}}),
+    ("Inclusion Criteria:\n* Age ≥ 18 years and < 65 years", {"age": {"min": 18.0, "max": 64.0}}),
+    ("Exclusion Criteria:\n* HbA1c < 7% or > 10%", {"hba1c": {"min": 7.0, "max": 10.0}}),
+    ("Exclusion Criteria:\n* HbA1c ≥ 7% and ≤ 10%", {}),
+])
+def test_two_sided_comparisons(text, expected):
+    assert parse_eligibility_criteria(text)["constraints"] == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Inclusion Criteria:\n* (≥18 years old)", {"age": {"min": 18.0}}),
+    ("Inclusion Criteria:\n* Adults (≥18 years old)", {"age": {"min": 18.0}}),
+    ("Inclusion Criteria:\n* 18 to 65 years old", {"age": {"min": 18.0, "max": 65.0}}),
+])
+def test_values_before_years_old(text, expected):
+    assert parse_eligibility_criteria(text)["constraints"] == expected
@@ -0,0 +1,24 @@
+from app import RESULT_REF_KEY, dehydrate_state, get_result_store, hydrate_state
+
+
+def test_pinned_results_survive_eviction_from_shared_store():
+    results = {"studies": [{"nctId": "NCT00000001"}], "totalCount": 1}
+    pinned = {}
+    compact = dehydrate_state({"api_results": results, "messages": []}, pinned)
+    assert RESULT_REF_KEY in compact["api_results"]
+
+    # Other sessions' searches push this session's results out of the shared LRU
+    store = get_result_store()
+    for index in range(store.max_entries + 1):
+        store.put({"other": index})
+    assert store.get(compact["api_results"][RESULT_REF_KEY]) is None
+
+    assert hydrate_state(compact, pinned)["api_results"] == results
+    assert hydrate_state(compact)["api_results"] == results
+
+
+def test_dehydrate_replaces_pinned_payloads():
+    pinned = {}
+    dehydrate_state({"api_results": {"studies": [1]}, "messages": []}, pinned)
+    compact = dehydrate_state({"api_results": {"studies": [2]}, "messages": []}, pinned)
+    assert list(pinned) == [compact["api_results"][RESULT_REF_KEY]]
@@ -0,0 +1,72 @@
+import json
+
+import requests
+
+from app import (
+    TRIALS_SUMMARY_FIELDS, SavedSearchStore, criteria_loaded, export_rows, patch_saved_results, process_study,
+    get_trial_criteria_cache, process_trials_page, trials_request_params, with_criteria
+)
+
+
+def test_search_asks_for_total_count():
+    assert trials_request_params("asthma")["countTotal"] == "true"
+
+
+def test_total_count_falls_back_to_page_length():
+    page = {"studies": [{"protocolSection": {"identificationModule": {"nctId": "NCT00000001"}}}]}
+    assert process_trials_page(page)["totalCount"] == 1
+
+
+def test_patched_total_never_drops_below_kept_trials():
+    saved = {"studies": [{"nctId": "NCT00000001", "overallStatus": "RECRUITING"}, {"nctId": "NCT00000002", "overallStatus": "RECRUITING"}], "totalCount": 0}
+    updates = {"studies": [{"nctId": "NCT00000002", "overallStatus": "COMPLETED"}]}
+    assert patch_saved_results(saved, updates, "2024-01-01")["totalCount"] == 1
+
+
+def test_saved_searches_expire_after_ttl(tmp_path):
+    store = SavedSearchStore(str(tmp_path / "saved_searches.db"), ttl_seconds=60)
+    store.save("old", "2024-01-01", {"studies": [], "totalCount": 0})
+    with store._conn:
+        store._conn.execute("UPDATE saved_searches SET used_at = 0 WHERE search_key = 'old'")
+    store._last_prune = 0
+    store.save("new", "2024-01-02", {"studies": [], "totalCount": 0})
+    assert store.load("old") is None
+    assert store.load("new") is not None
+
+
+def test_export_reads_lead_sponsor_name():
+    study = process_study({"protocolSection": {
+        "identificationModule": {"nctId": "NCT00000001"},
+        "sponsorCollaboratorsModule": {"leadSponsor": {"name": "Example University", "class": "OTHER"}}
+    }})
+    assert next(export_rows([study], {}, {}))["sponsor"] == "Example University"
+
+
+def test_criteria_are_loaded_in_one_request_for_the_trials_read(monkeypatch):
+    requested = []
+
+    def fake_get(url, params=None, **kwargs):
+        requested.append(params["filter.ids"])
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({"studies": [
+            {"protocolSection": {"identificationModule": {"nctId": nct_id}, "eligibilityModule": {"eligibilityCriteria": "Inclusion Criteria:\n* HbA1c 7-10%"}}}
+            for nct_id in params["filter.ids"].split(",")
+        ]}).encode()
+        return response
+
+    monkeypatch.setattr(requests, "get", fake_get)
+    get_trial_criteria_cache.clear()
+    studies = [process_study({"protocolSection": {"identificationModule": {"nctId": f"NCT0000000{index}"}}}) for index in range(5)]
+    assert "EligibilityCriteria" not in TRIALS_SUMMARY_FIELDS
+    assert not any(criteria_loaded(study) for study in studies)
+
+    loaded = with_criteria(studies, limit=3)
+    assert requested == ["NCT00000000,NCT00000001,NCT00000002"]
+    assert [criteria_loaded(study) for study in loaded] == [True, True, True, False, False]
+    assert loaded[0]["parsedCriteria"]["constraints"] == {"hba1c": {"min": 7.0, "max": 10.0}}
+    assert not criteria_loaded(studies[0])
+
+    # Cached criteria are not fetched again
+    with_criteria(studies, limit=3)
+    assert len(requested) == 1